@@ -11,21 +11,40 @@
 # and attribution and this message. No support is implied.
 #
 
+import functools
+import importlib.util
 import math
+import operator
 import random
-import sys
 import time
+import weakref
 
 random.seed() # initialize the random module
 
-import rospy # ROS module
+# Transport backends: ROS1, or an in-process bus with a simulated clock
+#
+import brtransport
+import brfleet
+import brtrace
+import brtelemetry
+import brlog
+import brviz
+import brplot
 
 # ROS message definitions
+# (stand-ins from brtransport are used when ROS is not installed)
 #
-from geometry_msgs.msg import Twist      # ROS Twist message
-from nav_msgs.msg import Odometry        # ROS Pose message
-from sensor_msgs.msg import LaserScan    # ROS laser msg
-from tf.transformations import quaternion_about_axis, euler_from_quaternion
+try:
+    if importlib.util.find_spec("rospy") is None: # ROS module, imported by brtransport
+        raise ImportError("rospy")
+    from geometry_msgs.msg import Twist      # ROS Twist message
+    from nav_msgs.msg import Odometry        # ROS Pose message
+    from sensor_msgs.msg import LaserScan    # ROS laser msg
+    from sensor_msgs.msg import Image
+    rosAvailable = True
+except ImportError:
+    from brtransport import Twist, Odometry, LaserScan, Image
+    rosAvailable = False
 
 
 # Useful additional modules
@@ -36,12 +55,10 @@ import numpy as np
 # OpenCV module
 #
 import cv2
-from sensor_msgs.msg import Image
-from cv_bridge import CvBridge, CvBridgeError
-
-# Mathplot lib
-#
-from matplotlib import pyplot as plt
+try:
+    from cv_bridge import CvBridge
+except ImportError:
+    CvBridge = None
 
 # Threading for multiple robots
 #
@@ -55,18 +72,38 @@ import threading
 #     
 # def twoMotor2One(self,vl,vr): # change vleft,vright to ROS topic; not called by user directly  
 # def doConnections(self,showCamera): # implement connections that have been made; not called by user directly
+# def startBehavior(self,...), tick(self), stopBehavior(self): # behave() in parts, for brfleet.FleetScheduler
 #
 # User callbacks
-# def connect(self,source,sink): # User: connect a sensor data source to a and actuator data sink
+# def connect(self,source,sink,weight=None,transfer=None): # User: connect a sensor data source to a and actuator data sink
+# def addSensorSource(self,attr,index=None,gain=None): # User: make any sensor value connectable
 # def behave(self,showCamera=False,showTouch=False,showLight=False,showPose=False):# User:Carry out braitenberg behavior
+# def traceBehaviors(self,on=True,printing=False,every=1): # User: record (and show) what behaviors do
+# def setTrigger(self,sensor=None,maxRate=30.0): # User: tick on each 'scan' or 'frame' instead of a fixed rate
+# def setBehaviorRate(self,b,rate=None,period=None,essential=False): # User: how often a behavior runs
+# def behaviorStats(self): # User: runs, skips and time per behavior
+# def setProfiling(self,on=True,path=None): # User: latency histograms of callbacks and behaviors
+# def stats(self): # User: the profiled latencies
+# def setImageWorker(self,on=True): # User: camera frames on a worker thread, newest frame only
+# def imageStats(self): # User: frames processed and dropped, feature age
+# def addColorTarget(self,name,minColor,maxColor,space='bgr'): # User: another target color, own light sensors
+# def colorLight(self,name): # User: the light sensors of that color
+# def setLightArray(self,k): # User: k light sensors across the camera view, v.lightArray
+# def setVision(self,roi=None,downscale=1): # User: camera band and size used for the light sensors
+# def recordSensors(self,path,frames='features'): # User: log sensor data for brlog.Replay
+# def stopRecording(self):
 # 
-# def plotPosition(self): # User: plot positions after the behavior has stopped
-# def plotMotors(self): # User: plot the velocities after the behavior has stopped
+# def startViewer(self,camera=True,mask=False,plots=True): # User: camera and live plots in another process
+# def stopViewer(self):
+# def plotPosition(self,path=None): # User: plot positions after the behavior has stopped
+# def plotMotors(self,path=None): # User: plot the velocities after the behavior has stopped
 #     
 # Other Non-braitenberg Callbacks
 # def callback_Shutdown(self):
 # def callback_Pose(self,msg):
 # def callback_Image(self,img):
+# def processImage(self,img,stamp):
+# def callback_Columns(self,msg): # simulator camera, in-process transport only
 # def callback_Laser(self,msg):
 #
 # Motion control
@@ -75,8 +112,13 @@ import threading
 # def spin(self,target_angle):
 #
 # Multiple robot
-# def multipleBehave() -- list of robots
-# def multiplePlotPosition() -- list of robots
+# def multipleBehave(vlist,threaded=False) -- list of robots
+# def multipleProcessBehave(factories) -- functions that make robots, one process each
+# def multiplePlotPosition(vlist,path=None) -- list of robots
+# def setFleetTouchedNames() -- list of robots
+#
+# Transport
+# def getDefaultTransport() -- ROS if installed, else the in-process bus
 # ----------------------------------------------
 
 
@@ -87,6 +129,7 @@ versionname = 'Version 4.2 Decemer 2023'
 # model names for multiple robots
 modelIndex =0
 modelNames=["","T2","T3","T4","T5"] #"" means 1st root compatible with single robot case
+                                    # and T6, T7, ... after these
 
 # IRM related names for convenience
 Released = True
@@ -94,6 +137,316 @@ Released = True
 # multiple robot gloal list (for name comparisons)
 multipleRobotList=[]
 
+# poses of every vehicle, for name comparisons: each transport (ROS, a
+# simulator, a replay) has its own table, so the vehicles of a finished
+# simulation are not seen by the next one; a fleet worker process sets
+# fleetPoses to the table shared by all its vehicles
+fleetPoses=None
+
+def poseTable(transport):
+    if fleetPoses is not None:
+        return fleetPoses
+    if getattr(transport,'fleetPoses',None) is None:
+        transport.fleetPoses=brfleet.FleetPoseTable()
+    return transport.fleetPoses
+touchedThreshold=0.1 # how close a contact must be to a vehicle to name it
+
+# what a vehicle records every tick (see setTelemetry); released has one
+# bit per behavior slot 0..63, and released1, released2 .. are added for
+# slots 64..127 and up; age is how old the sensor data behind the command is
+telemetryColumns=[('t','f8'),('x','f8'),('y','f8'),('yaw','f8'),
+                  ('vleft','f8'),('vright','f8'),
+                  ('lf_touch','f8'),('rf_touch','f8'),('lb_touch','f8'),('rb_touch','f8'),
+                  ('lf_light','f8'),('rf_light','f8'),('min_range','f8'),
+                  ('released','u8'),('age','f8')]
+
+# transport shared by every vehicle that does not ask for its own
+defaultTransport=None
+
+def getDefaultTransport():
+    global defaultTransport
+    if defaultTransport is None:
+        if rosAvailable:
+            defaultTransport = brtransport.RosTransport()
+        else:
+            print("Braitenros: ROS not found, using the in-process transport")
+            defaultTransport = brtransport.LocalTransport()
+    return defaultTransport
+
+# yaw angle of a quaternion (same as euler_from_quaternion(...)[2])
+def quaternionYaw(q):
+    return math.atan2(2.0*(q.w*q.z+q.x*q.y), 1.0-2.0*(q.y*q.y+q.z*q.z))
+
+# the pixels of a bgr8 or rgb8 image message as a height x width x 3
+# array, in the message's channel order, without copying: a view of
+# img.data that skips the padding at the end of each row
+def imgmsgView(img):
+    if img.encoding not in ("bgr8","rgb8"):
+        raise ValueError("no fast path for "+img.encoding+" images")
+    return np.ndarray((img.height,img.width,3),np.uint8,img.data,0,(img.step,3,1))
+
+# convert an image message to a BGR array without cv_bridge
+def imgmsgToBgr(img):
+    frame = imgmsgView(img)
+    if img.encoding=="rgb8":
+        frame = cv2.cvtColor(frame,cv2.COLOR_RGB2BGR)
+    return frame
+
+# the part of a camera frame searched for targets: only the rows in the
+# band roi (fractions of the height, top to bottom, None for all of them),
+# made scale (1, 2, 4 ..) times smaller by a pyramid of 2x2 pixel averages
+# (OpenCV's fast case, cheaper than pyrDown's smoothing). Returns it and
+# the first frame row it covers. With buffers (a VisionBuffers) every
+# step writes into reused arrays.
+def visionFrame(frame,roi=None,scale=1,buffers=None):
+    y0 = 0
+    if roi is not None:
+        h = frame.shape[0]
+        y0 = int(roi[0]*h)
+        frame = frame[y0:max(y0+1,int(roi[1]*h))]
+    while scale>1 and min(frame.shape[:2])>1:
+        size = (frame.shape[1]//2,frame.shape[0]//2)
+        dst = buffers.scratch((size[1],size[0])+frame.shape[2:]) if buffers is not None else None
+        frame = cv2.resize(frame,size,dst=dst,interpolation=cv2.INTER_AREA)
+        scale //= 2
+    return frame,y0
+
+# The color lookup table of addColorTarget: 32 levels per channel, entry
+# [r>>3, (b>>3) | (g>>3)<<8] holds the number (from 1) of the first
+# target that cell of colors belongs to, 0 for none (laid out so that
+# classifyColors can look it up with cv2.remap). A 'bgr' target is a
+# box of BGR colors and takes every cell that overlaps it; an 'hsv' target
+# is a box of OpenCV HSV colors (hue 0..179, a min hue above the max hue
+# wraps through red) and takes every cell whose center is inside.
+def colorLut(targets):
+    edges = np.arange(32)*8
+    b,g,r = np.meshgrid(edges,edges,edges,indexing='ij')
+    low = np.stack((b,g,r),axis=-1).reshape(-1,3)
+    high = low+7
+    hsv = cv2.cvtColor((low+4).astype(np.uint8).reshape(-1,1,3),cv2.COLOR_BGR2HSV).reshape(-1,3)
+    lut = np.zeros(len(low),np.uint8)
+    for k,(lo,hi,space) in enumerate(targets):
+        lo,hi = np.array(lo),np.array(hi)
+        if space=='hsv':
+            inside = np.all((hsv[:,1:]>=lo[1:])&(hsv[:,1:]<=hi[1:]),axis=1)
+            if lo[0]<=hi[0]:
+                inside &= (hsv[:,0]>=lo[0])&(hsv[:,0]<=hi[0])
+            else:
+                inside &= (hsv[:,0]>=lo[0])|(hsv[:,0]<=hi[0])
+        else:
+            inside = np.all((high>=lo)&(low<=hi),axis=1)
+        lut[inside&(lut==0)] = k+1
+    table = np.zeros((32,0x1f1f+1),np.uint16)
+    table[r.ravel()>>3,(b.ravel()>>3)|(g.ravel()>>3)<<8] = lut
+    return table
+
+# the target number of every pixel of an image (or any ... x 3 array of
+# colors) from the lookup table in one pass, as a label image. The levels
+# of a pixel are packed into a BGRA pixel whose two 16 bit halves (little
+# endian) are b|g<<8 and r, the column and row of the pixel's table entry,
+# so cv2.remap looks up the whole image at once.
+def classifyColors(frame,table,rgb=False,buffers=None,out=None):
+    shape = frame.shape[:-1]
+    if frame.size==0:
+        return np.zeros(shape,np.uint16)
+    if frame.ndim!=3:
+        frame = frame.reshape(-1,1,3)
+    if buffers is not None:
+        scratch = buffers.scratch
+    else:
+        scratch = lambda shape,dtype=np.uint8,name='':np.empty(shape,dtype)
+    levels = np.right_shift(frame,3,out=scratch(frame.shape,np.uint8,'levels'))
+    packed = cv2.cvtColor(levels,cv2.COLOR_RGB2BGRA if rgb else cv2.COLOR_BGR2BGRA,
+                          dst=scratch(frame.shape[:2]+(4,),np.uint8,'packed'))
+    pixels = packed.view(np.uint32)
+    np.bitwise_and(pixels,0xffffff,out=pixels) # alpha to 0
+    index = packed.view(np.int16).reshape(frame.shape[:2]+(2,))
+    labels = cv2.remap(table,index,None,cv2.INTER_NEAREST,dst=out)
+    return labels if labels.shape==shape else labels.reshape(shape)
+
+# target pixels of every label in each column of a label image, in one
+# pass: a histogram of column*(count+1)+label. Row k of the result is
+# label k (row 0 the pixels of no target).
+def labelColumns(labels,count,buffers):
+    h,w = labels.shape
+    n = count+1
+    if n*w>0x10000:
+        index = labels.astype(np.int64)+np.arange(w)*n
+        return np.bincount(index.ravel(),minlength=n*w).reshape(w,n).T
+    index = cv2.add(labels,buffers.columnOffsets(labels.shape,n),dst=buffers.scratch(labels.shape,np.uint16,'columns'))
+    return cv2.calcHist([index],[0],None,[n*w],[0,n*w]).astype(np.int32).reshape(w,n).T
+
+# Arrays reused from frame to frame by processImage, so it allocates
+# nothing per frame. A mask (or label image) is in use while the lazy
+# target_centers of the snapshots made from it have not been found, so
+# each mask remembers those functions (weakly: they go away with the
+# snapshots, or once run).
+class VisionBuffers():
+
+    def __init__(self):
+        self.scratches = {} # (name,shape,dtype) -> array used within one frame
+        self.masks = [] # [mask, weak references to the functions using it]
+
+    def scratch(self,shape,dtype=np.uint8,name=''):
+        key = (name,shape,dtype)
+        b = self.scratches.get(key)
+        if b is None:
+            b = self.scratches[key] = np.empty(shape,dtype)
+        return b
+
+    # column*n at every pixel of an image of this shape, for labelColumns
+    def columnOffsets(self,shape,n):
+        key = ('offsets',shape,n)
+        b = self.scratches.get(key)
+        if b is None:
+            b = self.scratches[key] = np.tile((np.arange(shape[1])*n).astype(np.uint16),(shape[0],1))
+        return b
+
+    # a mask of this shape that nothing uses any more; it counts as used
+    # until lend() says by what
+    def mask(self,shape,dtype=np.uint8):
+        for entry in self.masks:
+            if entry[0].shape==shape and entry[0].dtype==dtype and not any(r() for r in entry[1]):
+                entry[1] = self.taken
+                return entry[0]
+        self.masks = [e for e in self.masks if e[0].shape==shape] # frame size changed
+        self.masks.append([np.empty(shape,dtype),self.taken])
+        return self.masks[-1][0]
+
+    taken = (lambda:True,)
+
+    # mask is needed as long as any of users is
+    def lend(self,mask,*users):
+        for entry in self.masks:
+            if entry[0] is mask:
+                entry[1] = [weakref.ref(user) for user in users]
+        return
+
+# target pixels in each column of a simulator ColumnImage; inside(colors)
+# tells which of an array of BGR colors are the target
+def columnCounts(msg,inside):
+    counts = np.zeros(msg.width)
+    covered = np.zeros(msg.width)
+    for colors,extents in msg.layers:
+        counts += np.maximum(extents-covered,0)*inside(colors)
+        covered = np.maximum(covered,extents)
+    if inside(np.array([msg.background]))[0]:
+        counts += msg.height-covered
+    return counts
+
+# k light sensors side by side across the image, left to right, from the
+# target pixels of each image column: sensor i gets the columns of the
+# i-th 1/k of the image, as 255 x its share of all pixels of the frame
+# (so together they make the same total as lf_light+rf_light)
+def columnLights(counts,k,pixels):
+    n = len(counts)
+    sensor = (np.arange(n)*k)//n
+    return (255.0/pixels)*np.bincount(sensor,weights=counts,minlength=k)
+
+# runs of target columns stand in for the contours of the image
+def columnCenters(counts,h):
+    centers = []
+    on = np.concatenate(([0],(counts>0).astype(np.int8),[0]))
+    edges = np.flatnonzero(np.diff(on))
+    for start,end in zip(edges[0::2],edges[1::2]):
+        cx = np.average(np.arange(start,end),weights=counts[start:end])
+        centers.append((int(cx),h//2))
+    return centers
+
+# centers of the blobs of target number k of a label image
+def labelCenters(labels,k,scale,y0):
+    return maskCenters(cv2.inRange(labels,k,k),scale,y0)
+
+# center of each blob of a target mask, in frame coordinates
+def maskCenters(mask,scale,y0):
+    contours, _ = cv2.findContours(mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_TC89_L1)
+    centers = []
+    for contour in contours:
+        moments = cv2.moments(contour)
+        if moments['m00']>0:
+            centers.append((int(scale*moments['m10']/moments['m00']),
+                            y0+int(scale*moments['m01']/moments['m00'])))
+    return centers
+
+# time a vehicle method into the vehicle's profiler, if it has one
+# (see setProfiling); without a profiler this costs one attribute test
+def profiled(f):
+    name=f.__name__
+    @functools.wraps(f)
+    def timed(self,*args,**kwargs):
+        profiler=self.profiler
+        if profiler is None:
+            return f(self,*args,**kwargs)
+        start=time.perf_counter()
+        try:
+            return f(self,*args,**kwargs)
+        finally:
+            profiler.add(name,time.perf_counter()-start)
+    return timed
+
+# Sensor snapshots: a callback builds a complete new snapshot and swaps it
+# in with one assignment, never changing one that has been published.
+# Each behave() tick binds the latest snapshots, so every behavior in the
+# tick sees the same, whole sensor state without any locking. Only the
+# laser snapshot has a second writer (setTouched, which edits a copy of
+# the latest), so laser snapshots are published under laserLock.
+#
+class LaserSnapshot():
+    __slots__ = ('stamp','laserReadings','sectorMin','sectorIndex','mdq','mdi',
+                 'bumpLeft','bumpRight',
+                 'lf_touch','lb_touch','rb_touch','rf_touch',
+                 'lf_detect','lb_detect','rb_detect','rf_detect',
+                 'lf_touched','lb_touched','rb_touched','rf_touched')
+
+    def __init__(self):
+        self.stamp=None # transport time the scan arrived
+        self.laserReadings=np.zeros(360)
+        self.sectorMin=np.zeros(4)   # min distance in each sector, CCW from ahead
+        self.sectorIndex=np.zeros(4,dtype=int) # laser index of each sector min
+        self.mdq=np.zeros(4) #lf,lb,rb,rf; min distance quadrants
+        self.mdi=np.zeros(4,dtype=int) #lf,lb,rb,rf; min distance laser indices
+        self.bumpLeft,self.bumpRight=False,False
+        # contact variables, distance if touching else 0
+        self.lf_touch,self.lb_touch,self.rb_touch,self.rf_touch=0,0,0,0
+        # detection variables
+        self.lf_detect,self.lb_detect,self.rb_detect,self.rf_detect=0,0,0,0
+        # what name robot was touched
+        self.lf_touched,self.lb_touched,self.rb_touched,self.rf_touched=0,0,0,0
+
+    def copy(self):
+        snap = LaserSnapshot.__new__(LaserSnapshot)
+        for name in self.__slots__:
+            setattr(snap,name,getattr(self,name))
+        return snap
+
+class LightSnapshot():
+    __slots__ = ('stamp','lf_light','rf_light','target_x','target_angle','centers','findCenters',
+                 'colors','colorLights','lightArray')
+
+    def __init__(self,stamp=None,lf_light=0,rf_light=0,target_x=None,target_angle=None,target_centers=(),findCenters=None,
+                 colors=None,colorLights=None,lightArray=None):
+        self.stamp=stamp # transport time the frame arrived
+        self.lf_light,self.rf_light=lf_light,rf_light # an intensity value, positive real
+        self.target_x=target_x
+        self.target_angle=target_angle
+        self.centers=target_centers
+        self.findCenters=findCenters # makes the centers when first read
+        # the other color targets (see addColorTarget): name -> LightSnapshot,
+        # and their lf_light,rf_light pairs in one array
+        self.colors=colors if colors is not None else {}
+        self.colorLights=colorLights if colorLights is not None else np.zeros(0)
+        self.lightArray=lightArray if lightArray is not None else np.zeros(0) # see setLightArray
+
+    # the center of each target blob, found only if a behavior asks
+    @property
+    def target_centers(self):
+        if self.findCenters is not None:
+            self.centers=self.findCenters()
+            self.findCenters=None
+        return self.centers
+
+lightSensors = ('lf_light','rf_light','target_x','target_angle','target_centers')
+
 # ALV Class
 #
 class Braitenros():
@@ -101,19 +454,22 @@ class Braitenros():
     # Set up ALV member variables
     # Publishers etc
     #
-    def __init__(self, modelName='', simFlag=True, reference_frame=referenceFrame, rate=10,name=""):
+    def __init__(self, modelName='', simFlag=True, reference_frame=referenceFrame, rate=10,name="",transport=None):
         # initiliaze each robot
         global modelIndex,modelNames # names for multiple robot instances
         if modelName=='':
-            if modelIndex>=len(modelNames):
-                print("Cannot create another robot, sorry")
-                return
-            modelName = modelNames[modelIndex]
+            if modelIndex<len(modelNames):
+                modelName = modelNames[modelIndex]
+            else:
+                modelName = "T"+str(modelIndex+1)
             modelIndex += 1
         self.name=name
         self.modelName=""
-        rospy.loginfo(modelName+name+": To stop TurtleBot, type CTRL + C")
-        rospy.on_shutdown(self.callback_Shutdown)
+        if transport is None:
+            transport = getDefaultTransport()
+        self.transport=transport
+        transport.log(modelName+name+": To stop TurtleBot, type CTRL + C")
+        transport.onShutdown(self.callback_Shutdown)
         print("Braitenros: ",versionname," Configuring sensors & motors "+modelName+"...")      
         #user controlled diagnostics, flags to enable
         self.showCamera=False
@@ -121,32 +477,57 @@ class Braitenros():
         self.showLight =False
         self.showPose  =False
         self.showBehavior=True
+        self.showBehaviorEvery=1 # with showBehavior, print every n-th tick
         self.OneVisualObject=False
+        self.recorder=None # brlog.Recorder while recording sensor data
+        self.profiler=None # brtrace.Profiler while profiling
+        self.profilePath=None
+        # sensor state, see LaserSnapshot; the sensor attributes (lf_touch,
+        # lf_light ..) read the bound snapshots laser and light
+        self.latestLaser=self.laser=LaserSnapshot()
+        self.laserLock=threading.Lock() # publishing a laser snapshot, see setTouched
+        self.latestLight=self.light=LightSnapshot()
+        self.ticking=False # behave() binds snapshots once per tick
+        # event driven behave(): tick when the trigger sensor has new data
+        self.trigger=None # None (fixed rate), 'scan' or 'frame'
+        self.maxRate=30.0 # Hz, most ticks per second when triggered
+        self.triggerEvent=threading.Event()
+        self.commandAge=float('nan') # age of the sensor data behind the last command
+        # camera frames: processed in the callback, or on a worker thread
+        # that takes only the newest frame (see setImageWorker)
+        self.imageWorker=None
          # set up camera image transfer and callback
         print("    CV"),#end=' ');
-        self.cvBridge = CvBridge()
-        self.cameraImage = Image()
+        self.cvBridge = CvBridge() if CvBridge is not None else None
+        self.cameraFrame = Image() # last frame, in the message's channel order
+        self.cameraRgb = False # cameraFrame is rgb8, not bgr8
+        self.visionBuffers = VisionBuffers()
         self.simFlag=simFlag # remember
         if simFlag:
             self.imageTopic= modelName+'/camera/rgb/image_raw'
         else:
             self.imageTopic = modelName+'/raspicam_node/image_raw' # Gazebo: /camera/rgb/image_raw'
-        self.image_sub = rospy.Subscriber(self.imageTopic,Image,self.callback_Image)
+        self.image_sub = transport.subscribe(self.imageTopic,Image,self.callback_Image)
+        if transport.isLocal: # the simulator can skip rendering whole images
+            self.columnTopic = modelName+'/camera/columns'
+            self.column_sub = transport.subscribe(self.columnTopic,brtransport.ColumnImage,self.callback_Columns)
         
         # set up velocity publishing
         print("OK\n    Motors"),#end=' ')
         self.motionTopic=modelName+'/cmd_vel'
-        self.vel_pub = rospy.Publisher(self.motionTopic, Twist, queue_size=0)
+        self.vel_pub = transport.publisher(self.motionTopic, Twist)
         # set up laser callback and emergency 'bumper' sensors
         print("OK\n    Laser"),#end=' ')
         self.laserTopic=modelName+'/scan'
-        self.scan_sub = rospy.Subscriber(self.laserTopic, LaserScan, self.callback_Laser)
+        self.scan_sub = transport.subscribe(self.laserTopic, LaserScan, self.callback_Laser)
         # set up odometry callback
         
         print("OK\n    Odometry"),#end=' ')
         self.Pose =[0.0,0.0,0.0]
+        self.fleetPoses = poseTable(transport)
+        self.fleetRow = self.fleetPoses.register(name)
         self.poseTopic=modelName+'/odom'
-        self.pose_sub = rospy.Subscriber(self.poseTopic, Odometry, self.callback_Pose)
+        self.pose_sub = transport.subscribe(self.poseTopic, Odometry, self.callback_Pose)
         
         print("OK.\nAll done.\nInitializing member variables")
         self._relative_position = [0.0,0.0]
@@ -159,21 +540,7 @@ class Braitenros():
         # boolean bumper variables
         self.tooClose = 0.5 #meters, how close before the sensor is triggered    
         self.not2Close = 1.5 # meters, something seen but not too close
-        self.bumpLeft=False
-        self.bumpRight=False
-        self.laserReadings=[0]*360
-        
-
-        # contact variables 1= contact, 0= no contact
-        self.lf_touch, self.rf_touch=0,0
-        self.lb_touch, self.rb_touch=0,0
-        # detection variables
-        self.lf_detect, self.rf_detect=0,0
-        self.lb_detect, self.rb_detect=0,0
-
-        
-        self.mdq=[0,0,0,0] #lf,lb,rb,rf; min distance quadrants
-        self.mdi=[0,0,0,0] #lf,lb,rb,rf; min distance indices
+        self.laserSectors=4 # sectors for sectorMin, 4 to 360, a multiple of 4
         '''
         self.pmdq=[0,0,0,0] #lf,lb,rb,rf; prev min distance quadrants
         self.pmdi=[0,0,0,0] #lf,lb,rb,rf; pev min distance indices
@@ -182,18 +549,17 @@ class Braitenros():
         self.lf_moving, self.rf_moving=0,0
         self.lb_moving, self.rb_moving=0,0
         '''
-        # detection variables what name robot was touched
-        self.lf_touched, self.rf_touched=0,0
-        self.lb_touched, self.rb_touched=0,0
               
         # light variables
-        # an intensity value, positive real
-        self.lf_light, self.rf_light=0,0
         # target color, this color will be the light stimulus
         self.targetCol = [(200,200,200),(255,255,255)] # default is white paper
-        self.target_x = None
-        self.target_angle = None
-        self.target_centers=[]
+        self.colorTargets = [] # more target colors: (name,min,max,space), see addColorTarget
+        self.colorConnects = {} # name -> left and right light connect numbers
+        self.colorLut = None
+        self.lightArrayCount = 0 # light sensors across the image, see setLightArray
+        self.lightArrayConnects = []
+        self.visionRoi = None # band of image rows searched for the target, see setVision
+        self.visionScale = 1 # times smaller the frame is searched
         # motor variables
         self.vleft, self.vright=0,0
         
@@ -208,28 +574,61 @@ class Braitenros():
         
         self.vleft_connect = [] # a list of things that can be connected to the motor
         self.vright_connect = []# unconnected
+
+        # what each connect number reads: attribute, index into it, gain
+        self.motorGain = 0.15
+        self.lightGain = 0.005
+        self.sensorSources = [None,
+            ('lf_touch',None,'motor'),('lb_touch',None,'motor'),
+            ('rb_touch',None,'motor'),('rf_touch',None,'motor'),
+            ('lf_light',None,'light'),('rf_light',None,'light')]
+        self.connectionParams = {} # (motor,sink) -> (weight,transfer)
+        self.compiledKey = None
+        self.simBounds = 5.0 # meters, stop if the robot leaves +/- this (simulation)
         
-        # Collect data for graphing
-        self.poseListX = []
-        self.poseListY = []
-        self.vrightList = []
-        self.vleftList = []
         #--------------------------------
         
         #BBbraitenros
         self.behaviors=[]
-        self.behaviorOutput={} # dictionary (vleft,vright)
         self.rateSkip={} # dictionary (behavior,skip,counter)
+        self.behaviorTiming={} # behavior -> (period in seconds, essential)
+        # compiled behaviors: one slot per behavior function
+        self.slotIndex={} # behavior -> slot
+        self.slotBehaviors,self.slotNames=[],[]
+        self.skipPeriod,self.skipCount=[],[] # skip counters
+        self.runPeriod,self.nextDue=[],[] # seconds between runs, next run
+        self.essential=[] # never skipped to make the deadline
+        self.cost=[] # seconds per run, running average
+        self.runs,self.skips,self.lateSkips=[],[],[] # counts
+        self.outLeft,self.outRight,self.outStatus=[],[],[] # output registers
+        self.behaviorBudget=None # seconds for all behaviors per tick, None: half a period
+        self.planBudget=0.0
+        self.essentialCost=0.0 # cost of all the essential behaviors, kept up to date
+        self.essentialLeft=0.0 # cost of the essential behaviors still to run
+        self.planOverruns=0 # ticks whose behaviors took longer than the budget
+        self.planSlots=[] # slots in the order they are tried
+        self.groupEnds=[] # end of each top level entry in planSlots
+        self.tickCount=0
+        self.releasedSlots=[] # per top level entry, the slot released in the last tick or -1
+        self.trace=None # brtrace.BehaviorTrace when tracing
+        self.tracePrinter=None
+        self.viz=None # brviz.Visualizer while a viewer process shows this vehicle
         self.memory={} # state variables stored here
+
+        # Collect data for graphing, one row per behave() tick
+        self.setTelemetry()
        
         # set the robot to stationary
         self.rate=rate
         self.modelName=modelName
 
-        print("Braitenros: All done. 3 second delay before behavior starts..")
-        rospy.init_node('Braitenrosnode', anonymous=False) # everything is just 1 node
+        if not transport.isLocal: # in-process runs stay repeatable
+            self.setImageWorker(True)
+
+        print("Braitenros: All done. {:g} second delay before behavior starts..".format(brtransport.startDelay))
+        transport.initNode('Braitenrosnode') # everything is just 1 node
         self.setVel(0.0,0.0)
-        rospy.sleep(3)
+        transport.sleep(brtransport.startDelay)
         return
 
     # default system shutdown
@@ -240,17 +639,19 @@ class Braitenros():
         msg.angular.z=0.0
         msg.linear.x=0.0
         self.vel_pub.publish(msg) 
+        if self.imageWorker is not None:
+            self.imageWorker.stop()
+        self.fleetPoses.unregister(self.fleetRow)
         return
     
     #Callback for odometry
+    @profiled
     def callback_Pose(self,msg):
         
-        orient = msg.pose.pose.orientation
-        quat = [axis for axis in [orient.x, orient.y, orient.z, orient.w]]
-        (roll,pitch,yaw)=euler_from_quaternion(quat)
-        self.Pose[0]= msg.pose.pose.position.x
-        self.Pose[1]= msg.pose.pose.position.y
-        self.Pose[2]= yaw
+        yaw = quaternionYaw(msg.pose.pose.orientation)
+        x,y = msg.pose.pose.position.x, msg.pose.pose.position.y
+        self.Pose = [x,y,yaw] # replaced whole, never half updated
+        self.fleetPoses.update(self.fleetRow,x,y,yaw)
         return
     
     #convenience function to set the velocity
@@ -264,6 +665,7 @@ class Braitenros():
         return
         
     # change vleft,vright to ROS
+    @profiled
     def twoMotor2One(self,vl,vr):
        widthOfRobot = 0.5
        self.setVel( 0.5*(vr+vl), (vr-vl)/widthOfRobot)
@@ -275,11 +677,17 @@ class Braitenros():
     
     #flatten a nestd list
     def flatten(self,list_of_lists):
-        if len(list_of_lists) == 0:
-            return list_of_lists
-        if isinstance(list_of_lists[0], list):
-            return self.flatten(list_of_lists[0]) + self.flatten(list_of_lists[1:])
-        return list_of_lists[:1] + self.flatten(list_of_lists[1:])
+        flat=[]
+        stack=[iter(list_of_lists)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, list):
+                    stack.append(iter(item))
+                    break
+                flat.append(item)
+            else:
+                stack.pop()
+        return flat
     
     
        
@@ -292,14 +700,217 @@ class Braitenros():
         #print (blist)
         for b in blist:
             print(b.__name__),#end=" ")
-            self.addSkip(b,2)
+            if not b in self.rateSkip:
+                self.addSkip(b,2)
         print("]")
+        self.compileBehaviors()
         return
         
     # add a rate skip for this behavior
     def addSkip(self,b,skip):
         self.rateSkip[b]=[skip,0]
+        if b in self.slotIndex:
+            self.skipPeriod[self.slotIndex[b]]=skip
+            self.skipCount[self.slotIndex[b]]=0
         return
+
+    # run behavior b at most rate times (or once every period seconds) a
+    # second, instead of its rate skip; on other ticks its last output is
+    # used again. An essential behavior (e.g. an obstacle reflex) is never
+    # skipped when the behaviors run late; the others are, starting with
+    # whichever would overrun the budget, again reusing their last output
+    def setBehaviorRate(self,b,rate=None,period=None,essential=False):
+        if rate is not None:
+            period=1.0/rate
+        if period is None:
+            period=0.0
+        self.behaviorTiming[b]=(period,essential)
+        self.addSkip(b,0)
+        if b in self.slotIndex:
+            i=self.slotIndex[b]
+            self.runPeriod[i]=period
+            self.nextDue[i]=0.0
+            self.essential[i]=essential
+            self.sumEssentialCost()
+        return
+
+    def sumEssentialCost(self):
+        self.essentialCost=sum(c for c,e in zip(self.cost,self.essential) if e)
+        return
+
+    # the slot that holds the skip counter and outputs of behavior b
+    def behaviorSlot(self,b):
+        if not b in self.slotIndex:
+            self.slotIndex[b]=len(self.slotBehaviors)
+            self.slotBehaviors.append(b)
+            self.slotNames.append(b.__name__)
+            skip=self.rateSkip.get(b,[0,0])[0]
+            self.skipPeriod.append(skip)
+            self.skipCount.append(0)
+            period,essential=self.behaviorTiming.get(b,(0.0,False))
+            self.runPeriod.append(period)
+            self.nextDue.append(0.0)
+            self.essential.append(essential)
+            self.cost.append(0.0)
+            self.runs.append(0)
+            self.skips.append(0)
+            self.lateSkips.append(0)
+            self.outLeft.append(0)
+            self.outRight.append(0)
+            self.outStatus.append(False)
+        return self.slotIndex[b]
+
+    # compile the behaviors into a flat plan of slots. A priority list
+    # runs its entries until one is released; a nested list always
+    # counts as released, so nothing after it in its parent list runs.
+    # Each top level entry (summed) becomes one run of the plan ending
+    # at groupEnds[g]; a release jumps straight to that end.
+    def compileBehaviors(self):
+        self.planSlots=[]
+        self.groupEnds=[]
+        for b in self.behaviors:
+            entries=b
+            while type(entries) is list:
+                nested=None
+                for sub in entries:
+                    if type(sub) is list:
+                        nested=sub
+                        break
+                    self.planSlots.append(self.behaviorSlot(sub))
+                entries=nested
+            if entries is not None: # a single behavior
+                self.planSlots.append(self.behaviorSlot(entries))
+            self.groupEnds.append(len(self.planSlots))
+        self.releasedSlots=[-1]*len(self.groupEnds)
+        self.addReleasedColumns()
+        self.sumEssentialCost()
+        planned=set(self.planSlots)
+        unreached=[b.__name__ for b in self.flatten(self.behaviors) if self.slotIndex.get(b) not in planned]
+        if unreached:
+            print("Never reached (after a nested priority list): ",unreached)
+        return
+
+    # carry out the behavior in slot i; now is the transport time of
+    # this tick, planStart the perf_counter at the start of doPlan or
+    # None for no late skips (both passed in, the same for every slot)
+    def doSlot(self,i,now,planStart=None):
+        # is there a skip rate or period defined for this behavior
+        run = self.skipCount[i]==0 and now>=self.nextDue[i]-1e-6
+        if run and planStart is not None and not self.essential[i]:
+            # would it leave too little time for the essential ones
+            spent=time.perf_counter()-planStart
+            if spent+self.cost[i]+self.essentialLeft>self.planBudget:
+                run=False
+                self.lateSkips[i]+=1
+                self.cost[i]*=0.98 # try it again sometime
+        if not run:
+            if self.skipCount[i]>0:
+                self.skipCount[i]-=1 # just counting down
+            self.skips[i]+=1
+            self.vleft+=self.outLeft[i]
+            self.vright+=self.outRight[i]
+            status=self.outStatus[i]
+        else:
+            self.skipCount[i]=self.skipPeriod[i] # recharge it
+            if self.runPeriod[i]>0:
+                self.nextDue[i]+=self.runPeriod[i]
+                if self.nextDue[i]<=now: # fell behind, no catching up
+                    self.nextDue[i]=now+self.runPeriod[i]
+            # carry out a behavior
+            vleft,vright = self.vleft, self.vright  # only needed for skip
+            start=time.perf_counter()
+            status = self.slotBehaviors[i](self)
+            spent=time.perf_counter()-start
+            cost=spent if self.runs[i]==0 else 0.8*self.cost[i]+0.2*spent
+            if self.profiler is not None:
+                self.profiler.add(self.slotNames[i],spent)
+            self.runs[i]+=1
+            if self.essential[i]:
+                self.essentialCost+=cost-self.cost[i]
+                self.essentialLeft=max(0.0,self.essentialLeft-cost)
+            self.cost[i]=cost
+            # remember the effect of this behavior and whether it was released
+            self.outLeft[i]=self.vleft-vleft
+            self.outRight[i]=self.vright-vright
+            self.outStatus[i]=status
+        trace=self.trace
+        if trace is not None and trace.enabled: #whether the behavior was released or not
+            trace.record(self.tickCount,i,status,self.outLeft[i],self.outRight[i])
+        return status
+
+    # record what every behavior does on every tick into a ring buffer
+    # (self.trace); printing shows it like showBehavior, from a
+    # background thread, every n-th tick
+    def traceBehaviors(self,on=True,printing=False,every=1):
+        if self.tracePrinter is not None:
+            self.tracePrinter.stop()
+            self.tracePrinter=None
+        if not on:
+            if self.trace is not None:
+                self.trace.enabled=False
+            return
+        if self.trace is None:
+            self.trace=brtrace.BehaviorTrace(self.slotNames)
+        self.trace.enabled=True
+        if printing:
+            self.tracePrinter=brtrace.TracePrinter(self.trace,self.modelName,every)
+            self.tracePrinter.start()
+        return
+
+    # run the compiled plan once, summing the top level entries
+    @profiled
+    def doPlan(self,leftmotor,rightmotor):
+        pc=0
+        planSlots=self.planSlots
+        released=self.releasedSlots
+        doSlot=self.doSlot
+        now=self.transport.now()
+        self.planBudget=self.behaviorBudget if self.behaviorBudget is not None else 0.5/self.rate
+        self.essentialLeft=self.essentialCost
+        start=time.perf_counter()
+        # skipping late behaviors depends on the host's speed, so not in
+        # simulated or replayed runs, which must repeat exactly
+        planStart=None if self.transport.isLocal else start
+        for g,end in enumerate(self.groupEnds):
+            released[g]=-1
+            while pc<end:
+                if doSlot(planSlots[pc],now,planStart):
+                    released[g]=planSlots[pc]
+                    break # subsumes the rest of this entry
+                pc+=1
+            pc=end
+            leftmotor+=self.vleft
+            rightmotor+=self.vright
+        if time.perf_counter()-start>self.planBudget:
+            self.planOverruns+=1
+        return leftmotor,rightmotor
+
+    # time the callbacks, doConnections, every behavior and the motor
+    # command of this vehicle; path: write the results as JSON when
+    # behave() ends
+    def setProfiling(self,on=True,path=None):
+        if not on:
+            self.profiler=None
+            return
+        if self.profiler is None:
+            self.profiler=brtrace.Profiler()
+        self.profilePath=path
+        return
+
+    # latency of everything profiled so far: name -> count, mean, p50,
+    # p90, p99 and max, in seconds
+    def stats(self):
+        if self.profiler is None:
+            return {}
+        return self.profiler.stats()
+
+    # per behavior: runs, skips (of which because of the budget), the
+    # average seconds per run and the rate settings
+    def behaviorStats(self):
+        return [{'name':self.slotNames[i],'runs':self.runs[i],'skips':self.skips[i],
+                 'lateSkips':self.lateSkips[i],'cost':self.cost[i],
+                 'period':self.runPeriod[i],'skip':self.skipPeriod[i],'essential':self.essential[i]}
+                for i in range(len(self.slotBehaviors))]
         
     # functions to manipulate the memory dictionary
     
@@ -309,6 +920,19 @@ class Braitenros():
        #print("Remember ",name," is ",self.memory[name])
        return
     
+    # the fleet blackboard: slot k (0..7) of this vehicle's row, which
+    # every vehicle, also in other processes, can read by name
+    def share(self,k,value):
+        self.fleetPoses.board[self.fleetRow,k]=value
+        return
+
+    def recallShared(self,name,k):
+        row=self.fleetPoses.rowOf(name)
+        if row<0:
+            print(name," is not a vehicle name.")
+            return 0
+        return float(self.fleetPoses.board[row,k])
+
     # if name is in memory dictionary return its value
     def recall(self,name):
        if name in self.memory:
@@ -342,7 +966,7 @@ class Braitenros():
        #    print(name+"!"),# end=" ")
        return trig
         
-    # carry out behavior b 
+    # carry out behavior b (behave() runs the compiled plan instead)
     def doBB(self,b):
         # is this a behavior or a priority list
         if type(b) is list:
@@ -351,290 +975,651 @@ class Braitenros():
                     #print(sub.__name__," is subsuming")
                     break
             return True 
-        # is there a skip rate defined for this behavior
-        if (b in self.rateSkip):
-            if self.rateSkip[b][1]>0:
-                self.rateSkip[b][1]-=1 # just counting down
-                prior = self.behaviorOutput[b] # vleft,vright,status
-                self.vleft=+prior[0]
-                self.vright+=prior[1]
-                #print("Rate Skipped ",b.__name__)
-                flag="-"
-                if prior[2]:
-                    flag="+"
-                if self.showBehavior:
-                    print(b.__name__+flag),#end=" ")
-                return prior[2]
-            else:
-                self.rateSkip[b][1]=self.rateSkip[b][0] # recharge it
-        # carry out a behavior
-        #print(b.__name__)
-        vleft,vright = self.vleft, self.vright  # only needed for skip
-        status = b(self)
-        # remember the effect of this behavior and whether it was released
-        self.behaviorOutput[b]=(self.vleft-vleft,self.vright-vright,status)
-        #if status:
-        #    print("Behavior \""+b.__name__+"\" released.")
-        flag="-" #indicate whether the behavior was released or not
-        if status:
-            flag="+"
-        if self.showBehavior:
-            print(b.__name__+flag),#end=" ")
-        return status
+        return self.doSlot(self.behaviorSlot(b),self.transport.now())
          
     # connect a sensor data source to a and actuator data sink   
-    def connect(self,source,sink):
+    # a negative sink is an inhibitory connection; weight replaces the
+    # default gain and transfer(value) is applied to the sensor value first
+    def connect(self,source,sink,weight=None,transfer=None):
        # add another connection to source for sink
        if not sink in source:
            source.append(sink)
+       motor = 0 if source is self.vleft_connect else 1
+       if weight is not None or transfer is not None:
+           self.connectionParams[(motor,sink)] = (weight,transfer)
+       self.compiledKey = None
        return
-       
+
+    # make any sensor value connectable, e.g. addSensorSource('sectorMin',3)
+    # returns the number to use with connect
+    def addSensorSource(self,attr,index=None,gain=None):
+        self.sensorSources.append((attr,index,gain if gain is not None else 'motor'))
+        return len(self.sensorSources)-1
+
+    # turn the connection lists into a weight matrix W (motors x sensors)
+    # and bias so that each tick is motors = W.sensors + bias
+    def compileConnections(self):
+        used = [] # sensor source numbers, one per column of W
+        columns = {}
+        linear = []
+        nonlinear = [] # (motor,column,weight,bias,transfer)
+        for motor,conns in enumerate((self.vleft_connect,self.vright_connect)):
+            for sink in conns:
+                sign = 1 if sink>0 else -1
+                attr,index,gain = self.sensorSources[abs(sink)]
+                if abs(sink) not in columns:
+                    columns[abs(sink)] = len(used)
+                    used.append(abs(sink))
+                col = columns[abs(sink)]
+                weight,transfer = self.connectionParams.get((motor,sink),(None,None))
+                if weight is None:
+                    weight = {'motor':self.motorGain,'light':self.lightGain}.get(gain,gain)
+                # inhibitory connections start from motorGain, as braitenros always did
+                bias = self.motorGain if sign<0 else 0.0
+                if transfer is None:
+                    linear.append((motor,col,sign*weight,bias))
+                else:
+                    nonlinear.append((motor,col,sign*weight,bias,transfer))
+        W = np.zeros((2,len(used)))
+        bias = np.zeros(2)
+        for motor,col,weight,b in linear:
+            W[motor,col] += weight
+            bias[motor] += b
+        for motor,col,weight,b,transfer in nonlinear:
+            bias[motor] += b
+        # read each sensor attribute once, and pick the indices used from it
+        gathers = {}
+        for col,n in enumerate(used):
+            attr,index,gain = self.sensorSources[n]
+            gathers.setdefault(attr,([],[]))
+            gathers[attr][0].append(col)
+            gathers[attr][1].append(index)
+        self.connectionW = W
+        self.connectionBias = bias
+        self.connectionNonlinear = [(m,c,w,t) for m,c,w,b,t in nonlinear]
+        self.connectionGathers = [(attr,np.array(cols),None if None in idx else np.array(idx))
+                                  for attr,(cols,idx) in gathers.items()]
+        self.connectionCount = len(used)
+        return
+
+    # current values of the connected sensors, in the columns of W
+    def sensorVector(self):
+        sv = np.empty(self.connectionCount)
+        for attr,cols,idx in self.connectionGathers:
+            if idx is None:
+                sv[cols] = getattr(self,attr)
+            else:
+                sv[cols] = np.asarray(getattr(self,attr))[idx]
+        return sv
+
     # implement connections
+    @profiled
     def doConnections(self,showCamera):
-       #showCamera=True
-       motor_gain= 0.15
-       light_gain = 0.005
-
-       if showCamera:
-           cv2.namedWindow("Camera")
-       
-       #while not rospy.is_shutdown():
-       try:
-           # propagate sensors to motors
-           self.vleft,self.vright=0,0
-           cap = motor_gain # first time around, for sense=-1
-
-           for sense in [-1,1]:
-               # vleft connection
-               # touch sensors
-               if sense*self.lf_touch_connect in self.vleft_connect:
-                   self.vleft += cap + sense*self.lf_touch*motor_gain
-               if sense*self.lb_touch_connect in self.vleft_connect:
-                   self.vleft += cap + sense*self.lb_touch*motor_gain
-               if sense*self.rb_touch_connect in self.vleft_connect:
-                   self.vleft += cap + sense*self.rb_touch*motor_gain
-               if sense*self.rf_touch_connect in self.vleft_connect:
-                   self.vleft += cap + sense*self.rf_touch*motor_gain
-               # light sensors
-               if sense*self.rf_light_connect in self.vleft_connect:
-                   self.vleft += cap + sense*self.rf_light*light_gain
-               if sense*self.lf_light_connect in self.vleft_connect:
-                   self.vleft += cap + sense*self.lf_light*light_gain
- 
-               # vright connection
-               # touch sensors
-               if sense*self.lf_touch_connect in self.vright_connect:
-                   self.vright += cap + sense*self.lf_touch*motor_gain
-               if sense*self.lb_touch_connect in self.vright_connect:
-                   self.vright += cap + sense*self.lb_touch*motor_gain
-               if sense*self.rb_touch_connect in self.vright_connect:
-                   self.vright += cap + sense*self.rb_touch*motor_gain
-               if sense*self.rf_touch_connect in self.vright_connect:
-                   self.vright += cap + sense*self.rf_touch*motor_gain
-               # light sensors
-               if sense*self.rf_light_connect in self.vright_connect:
-                   self.vright += cap + sense*self.rf_light*light_gain
-               if sense*self.lf_light_connect in self.vright_connect:
-                   self.vright += cap + sense*self.lf_light*light_gain
-               # end of connections
-               cap = 0 # second time around, for sense=1
-           #make it happen
-          
-           if self.simFlag and (abs(self.Pose[0])>5 or abs(self.Pose[1]>5)):
-               self.vleft,self.vright=0.0,0.0
-               print("Stopped: Out of bounds [+/-5,+/-5]")
-               self.twoMotor2One(self.vleft,self.vright)
-               raise(rospy.ROSInterruptException)
-          
-           #self.twoMotor2One(self.vleft,self.vright)
-           
-           self.poseListX.append(self.Pose[0])
-           self.poseListY.append(self.Pose[1])
-
-           if showCamera: # some diagnostic capability
-               cv2.imshow("Camera"+self.modelName, cv2.resize(self.cameraImage,(320,240)))
-               ret=cv2.waitKey(2) # HAVE to do this for image to show in the window
-               #print("LF:",self.lf_light," RF:",self.rf_light)
-               #print("X:",self.Pose[1]," Y:",self.Pose[1])
-               #print("Vleft:",self.vleft," Vright:",self.vright)
-               
-       except:
-           pass
-           
+       # propagate sensors to motors
+       self.vleft,self.vright=0,0
+       key = (tuple(self.vleft_connect),tuple(self.vright_connect),self.motorGain,self.lightGain)
+       if key!=self.compiledKey:
+           self.compileConnections()
+           self.compiledKey = key
+       if self.connectionCount>0:
+           sv = self.sensorVector()
+           motors = self.connectionW.dot(sv)+self.connectionBias
+           for motor,col,weight,transfer in self.connectionNonlinear:
+               motors[motor] += weight*transfer(sv[col])
+           self.vleft,self.vright = motors.tolist()
+       #make it happen
+      
+       if self.simFlag and self.simBounds is not None and \
+          (abs(self.Pose[0])>self.simBounds or abs(self.Pose[1])>self.simBounds):
+           self.vleft,self.vright=0.0,0.0
+           print("Stopped: Out of bounds [+/-{0},+/-{0}]".format(self.simBounds))
+           self.twoMotor2One(self.vleft,self.vright)
+           raise(self.transport.InterruptException("out of bounds"))
+      
+       #self.twoMotor2One(self.vleft,self.vright)
+       # the camera is shown by the viewer process (see startViewer)
        return
        
     #  
     #Carry out a braitenberg behavior
     #
     def behave(self,showCamera=False,showTouch=False,showLight=False,showPose=False):
+        self.startBehavior(showCamera,showTouch,showLight,showPose)
+        try:
+            if self.trigger is None:
+                rate = self.transport.rate(self.rate)
+            else: # never slower than the fixed rate would be
+                self.triggerEvent.clear()
+                rate = brtransport.TriggerRate(self.transport,self.triggerEvent,self.maxRate,1.0/self.rate)
+            
+            while not self.transport.isShutdown():
+                self.tick()
+                rate.sleep()
+        except self.transport.InterruptException:
+            pass
+        self.stopBehavior()
+        return
+
+    # behave() in three parts, so that a scheduler can tick many vehicles
+    def startBehavior(self,showCamera=False,showTouch=False,showLight=False,showPose=False):
         self.showCamera=showCamera
         self.showTouch =showTouch
         self.showLight =showLight
         self.showPose  =showPose
+        if (showCamera or showLight) and self.viz is None:
+            self.startViewer(camera=showCamera,mask=showLight,plots=False)
         print("Braitenros: behavior starting now.")
-        try:
-            rate = rospy.Rate(self.rate)
-            
-            while not rospy.is_shutdown():
-                leftmotor,rightmotor=0,0
-                self.doConnections(showCamera)
-                leftmotor,rightmotor=self.vleft,self.vright
-                if self.showBehavior:
-                    print(self.modelName," ["),#end=" ")
-                for b in self.behaviors:
-                    self.doBB(b)
-                    leftmotor+=self.vleft
-                    rightmotor+=self.vright               
-                self.twoMotor2One(leftmotor,rightmotor)
-                self.vrightList.append(rightmotor)
-                self.vleftList.append(leftmotor)
-          
-                if self.showBehavior:
-                    print("]")
-                if showPose:
-                    print("X,Y,Angle:",self.Pose)
-                rate.sleep()
-        except rospy.ROSInterruptException:
-            print("Braitenros: behavior has been terminated.")
-            return
-            pass
+        if self.showBehavior:
+            self.traceBehaviors(True,printing=True,every=self.showBehaviorEvery)
+        self.ticking=True
+        return
+
+    # one pass of connections and behaviors; raises the transport's
+    # InterruptException when the vehicle has to stop
+    @profiled
+    def tick(self):
+        self.laser,self.light=self.latestLaser,self.latestLight # this tick's sensors
+        leftmotor,rightmotor=0,0
+        self.doConnections(self.showCamera)
+        leftmotor,rightmotor=self.vleft,self.vright
+        leftmotor,rightmotor=self.doPlan(leftmotor,rightmotor)
+        stamp = self.light.stamp if self.trigger=='frame' else self.laser.stamp
+        self.commandAge = self.transport.now()-stamp if stamp is not None else float('nan')
+        self.twoMotor2One(leftmotor,rightmotor)
+        self.recordTelemetry(leftmotor,rightmotor)
+        if self.viz is not None:
+            self.showTick(leftmotor,rightmotor)
+        self.tickCount+=1
+  
+        if self.showPose:
+            print("X,Y,Angle:",self.Pose)
+        return
+
+    def stopBehavior(self):
+        self.ticking=False
+        if self.profiler is not None and self.profilePath is not None:
+            self.profiler.save(self.profilePath,{'vehicle':self.modelName,'behaviors':self.behaviorStats(),
+                                                 'image':self.imageStats()})
+            print("Braitenros: profile written to "+self.profilePath)
+        self.laser,self.light=self.latestLaser,self.latestLight
+        if self.tracePrinter is not None:
+            self.tracePrinter.stop()
+            self.tracePrinter=None
+        if self.viz is not None:
+            self.viz.close() # its windows stay open
+            self.viz=None
         print("Braitenros: behavior has been terminated.")
         return
         
-    # plot position
-    def plotPosition(self):
-        if not self.simFlag:
-            f=open("position.csv","w")
-            for x,y in zip(self.poseListX, self.poseListY):
-                f.write(str(x)+","+str(y)+"\n")
-            f.close()
-            print("Position data written to position.csv")
+    # tick behave() whenever the sensor ('scan' or 'frame') has new data,
+    # at most maxRate times a second, instead of at the fixed rate; the
+    # fixed rate still ticks if the sensor goes quiet. None: fixed rate
+    def setTrigger(self,sensor=None,maxRate=30.0):
+        if sensor not in (None,'scan','frame'):
+            print("Braitenros: trigger must be None, 'scan' or 'frame', not ",sensor)
             return
-        plt.scatter(self.poseListX, self.poseListY, marker=".")
-        plt.title("Robot position")
-        plt.xlabel("X")
-        plt.ylabel("Y")
-        print("The program will not continue until you kill the plot window")
-        plt.show()
+        self.trigger=sensor
+        self.maxRate=maxRate
+        return
+
+    # record of the run: time, pose, motors, sensor summary and the
+    # behaviors released, one row per tick in preallocated chunks.
+    # maxSamples bounds the memory: policy 'decimate' thins out the whole
+    # run, 'drop' forgets the oldest rows; spillDir keeps rows on disk
+    def setTelemetry(self,maxSamples=1<<18,policy='decimate',every=1,spillDir=None):
+        self.telemetry = brtelemetry.Telemetry(telemetryColumns,maxSamples=maxSamples,
+                                               policy=policy,every=every,spillDir=spillDir)
+        self.releasedWords=[0]
+        self.addReleasedColumns()
         return
+
+    # one 64 bit released column per 64 behavior slots
+    def addReleasedColumns(self):
+        words=max(1,(len(self.slotBehaviors)+63)//64)
+        for k in range(len(self.releasedWords),words):
+            self.telemetry.addColumn('released{}'.format(k),'u8')
+            self.releasedWords.append(0)
+        return
+
+    def recordTelemetry(self,leftmotor,rightmotor):
+        pose=self.Pose
+        words=self.releasedWords
+        for k in range(len(words)):
+            words[k]=0
+        for slot in self.releasedSlots:
+            if slot>=0:
+                words[slot>>6]|=1<<(slot&63)
+        self.telemetry.append(self.transport.now(),pose[0],pose[1],pose[2],
+                              leftmotor,rightmotor,
+                              self.lf_touch,self.rf_touch,self.lb_touch,self.rb_touch,
+                              self.lf_light,self.rf_light,self.sectorMin.min(),
+                              words[0],self.commandAge,*words[1:])
+        return
+
+    # the old graphing lists, now columns of the telemetry
+    @property
+    def poseListX(self):
+        return self.telemetry.column('x')
+
+    @property
+    def poseListY(self):
+        return self.telemetry.column('y')
+
+    @property
+    def vleftList(self):
+        return self.telemetry.column('vleft')
+
+    @property
+    def vrightList(self):
+        return self.telemetry.column('vright')
+
+    # show the camera (and target mask) and a live plot of the position and
+    # motor speeds in a separate viewer process, so the behavior never
+    # waits on a window; behave(showCamera=True) starts one by itself
+    def startViewer(self,camera=True,mask=False,plots=True):
+        self.stopViewer()
+        self.viz=brviz.Visualizer(self.modelName,camera,mask,plots).start()
+        return self.viz
+
+    def stopViewer(self):
+        if self.viz is not None:
+            self.viz.close()
+            self.viz=None
+        return
+
+    # this tick's pose, motors and sensors to the viewer
+    def showTick(self,leftmotor,rightmotor):
+        pose=self.Pose
+        self.viz.sample(self.transport.now(),pose[0],pose[1],pose[2],leftmotor,rightmotor,
+                        (self.lf_touch,self.lb_touch,self.rb_touch,self.rf_touch,
+                         self.lf_detect,self.lb_detect,self.rb_detect,self.rf_detect,
+                         self.lf_light,self.rf_light))
+        return
+
+    # plot position after the run, in a separate process: the program
+    # carries on, the plot stays until its window is closed. With path
+    # (.png, .svg ..) the plot is written there instead, no window needed.
+    # Long runs are decimated and drawn over a heatmap, see brplot
+    def plotPosition(self,path=None):
+        if path is None and not self.simFlag:
+            np.savetxt("position.csv",np.column_stack((self.poseListX,self.poseListY)),delimiter=",")
+            print("Position data written to position.csv")
+            return
+        prepared=brplot.preparePositions([(None,self.poseListX,self.poseListY)],title="Robot position "+self.modelName)
+        return brplot.output(prepared,path)
         
     #plot the velocities
-    def plotMotors(self):
-        if not self.simFlag:
-            f=open("motors.csv","w")
-            for x,y in zip(self.vrightList, self.vleftList):
-                f.write(str(x)+","+str(y)+"\n")
-            f.close()
+    def plotMotors(self,path=None):
+        if path is None and not self.simFlag:
+            np.savetxt("motors.csv",np.column_stack((self.vrightList,self.vleftList)),delimiter=",")
             print("Motor data written to motors.csv")
             return
-        plt.plot(self.vrightList,label="Right", marker="4")
-        plt.plot(self.vleftList, label="Left",marker="3")
-        plt.title("Motor speeds")
-        plt.xlabel("Time Step")
-        plt.ylabel("Speed")
-        plt.legend(loc="upper right")
-        print("The program will not continue until you kill the plot window")
-        plt.show()
-        return
+        prepared=brplot.prepareMotors([(None,self.telemetry.column('t'),self.vleftList,self.vrightList)],
+                                      title="Motor speeds "+self.modelName)
+        return brplot.output(prepared,path)
         
     # allow the user to select what color will be used to identify a target
     def setColorTarget(self, minColor,maxColor):
         self.targetCol = [ minColor, maxColor ]
+
+    # track another target color besides the main one, with its own left
+    # and right light sensors: v.colorLight(name).lf_light, .rf_light,
+    # .target_x, .target_angle and .target_centers. space='hsv' gives min
+    # and max as OpenCV HSV colors. All added colors are found in one pass
+    # over the image with a lookup table of 32 levels per channel, so the
+    # color bounds are only kept to within 8 levels. Returns the connect
+    # numbers of the left and right sensor, for connect()
+    def addColorTarget(self,name,minColor,maxColor,space='bgr'):
+        if space not in ('bgr','hsv'):
+            print("Braitenros: space must be 'bgr' or 'hsv', not ",space)
+            return None
+        names = [t[0] for t in self.colorTargets]
+        if name in names:
+            self.colorTargets[names.index(name)] = (name,minColor,maxColor,space)
+        elif len(names)==255:
+            print("Braitenros: too many color targets")
+            return None
+        else:
+            k = len(self.colorTargets)
+            self.colorTargets.append((name,minColor,maxColor,space))
+            self.colorConnects[name] = (self.addSensorSource('colorLights',2*k,'light'),
+                                        self.addSensorSource('colorLights',2*k+1,'light'))
+        self.colorLut = colorLut([t[1:] for t in self.colorTargets])
+        return self.colorConnects[name]
+
+    # the light sensors of a color added with addColorTarget
+    def colorLight(self,name):
+        snap = self.light.colors.get(name)
+        return snap if snap is not None else LightSnapshot()
+
+    # lf_light,rf_light of every added color, in the order added
+    @property
+    def colorLights(self):
+        lights = self.light.colorLights
+        if len(lights)<2*len(self.colorTargets): # colors added since the frame
+            lights = np.concatenate((lights,np.zeros(2*len(self.colorTargets)-len(lights))))
+        return lights
+
+    # k light sensors spread evenly across the camera's field of view, left
+    # to right, read as the array v.lightArray (0 turns them off). Returns
+    # the connect numbers of the k sensors, for connect()
+    def setLightArray(self,k):
+        self.lightArrayCount = k
+        self.lightArrayConnects = [self.addSensorSource('lightArray',i,'light') for i in range(k)]
+        return self.lightArrayConnects
+
+    @property
+    def lightArray(self):
+        lights = self.light.lightArray
+        if len(lights)!=self.lightArrayCount: # set since the frame
+            return np.zeros(self.lightArrayCount)
+        return lights
+
+    # look for the target only in a band of image rows, roi=(top,bottom)
+    # as fractions of the height, e.g. (0.25,0.75), and in an image made
+    # downscale (1, 2, 4 ..) times smaller; both save camera processing
+    def setVision(self,roi=None,downscale=1):
+        if downscale not in (1,2,4,8):
+            print("Braitenros: downscale must be 1, 2, 4 or 8, not ",downscale)
+            return
+        if roi is not None and not 0<=roi[0]<roi[1]<=1:
+            print("Braitenros: roi must be (top,bottom) fractions, not ",roi)
+            return
+        self.visionRoi = roi
+        self.visionScale = downscale
+        return
    
+    # the last camera frame as a BGR array (an rgb8 frame is converted
+    # only when this is read)
+    @property
+    def cameraImage(self):
+        frame = self.cameraFrame
+        if self.cameraRgb and isinstance(frame,np.ndarray):
+            return cv2.cvtColor(frame,cv2.COLOR_RGB2BGR)
+        return frame
+
+    # process camera frames on a worker thread that always takes the newest
+    # frame and drops any that arrive while it is busy, so the light
+    # sensors are never more than one frame behind (on by default with ROS)
+    def setImageWorker(self,on=True):
+        if self.imageWorker is not None:
+            self.imageWorker.stop()
+            self.imageWorker=None
+        if on:
+            self.imageWorker=brtransport.LatestWorker(self.processImage,self.transport.now,"image"+self.modelName)
+        return
+
+    # frames received, processed and dropped by the image worker, frames
+    # processed per second and the age of the light sensors when set
+    def imageStats(self):
+        if self.imageWorker is None:
+            return {}
+        return self.imageWorker.stats()
+
     #Callback to store the latest image
+    @profiled
     def callback_Image(self,img):
         '''Called automatically for each new image'''
+        stamp=self.transport.now()
+        if self.imageWorker is not None:
+            self.imageWorker.put(img,stamp)
+        else:
+            self.processImage(img,stamp)
+        return
+
+    # find the target in a camera frame that arrived at time stamp
+    @profiled
+    def processImage(self,img,stamp):
         #print("1",end=' ') # estimate sense/action time ratio
-        self.cameraImage = self.cvBridge.imgmsg_to_cv2(img, "bgr8")
-        src = self.cameraImage
+        # bgr8 and rgb8 frames are used in place; an rgb8 frame is not
+        # converted, the target color bounds are swapped instead
+        lo,hi = self.targetCol
+        if img.encoding in ("bgr8","rgb8"):
+            src = imgmsgView(img)
+            rgb = img.encoding=="rgb8"
+            if rgb:
+                lo,hi = tuple(lo)[::-1],tuple(hi)[::-1]
+        elif self.cvBridge is not None:
+            src,rgb = self.cvBridge.imgmsg_to_cv2(img, "bgr8"),False
+        else:
+            src,rgb = imgmsgToBgr(img),False
+        self.cameraRgb = rgb
+        self.cameraFrame = src
         h, w, c = src.shape
         
-        iss=h*w*1
         # make a binary image that is 0 except where the color is in range
-        targetImage = cv2.inRange(src,self.targetCol[0],self.targetCol[1])
-
-        #Complex Visual Systems - multiple objects, outputs self.target_centers
-        contours, _ = cv2.findContours(targetImage.copy(), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_TC89_L1)
-        self.target_centers = []
-        for i in range(len(contours)):
-            moments = cv2.moments(contours[i])
-            if moments['m00']>0:
-                self.target_centers.append((int(moments['m10']/moments['m00']), int(moments['m01']/moments['m00'])))
-                cv2.circle(targetImage, self.target_centers[-1], 3, (0, 0, 255), -1)
-                # extract the moments of the target image
-                
+        # (only in the roi band, at 1/scale of the size)
+        scale = self.visionScale
+        buffers = self.visionBuffers
+        small,y0 = visionFrame(src,self.visionRoi,scale,buffers)
+        targetImage = cv2.inRange(small,lo,hi,dst=buffers.mask(small.shape[:2]))
+
+        # the added colors: one label image, and the pixels of every color
+        # in each column from it in one pass
+        colors,colorLights = {},None
+        if self.colorTargets:
+            labels = classifyColors(small,self.colorLut,rgb,buffers,buffers.mask(small.shape[:2],np.uint16))
+            counts = labelColumns(labels,len(self.colorTargets),buffers)
+            colorLights = np.zeros(2*len(self.colorTargets))
+            finders = []
+            for k,(name,cmin,cmax,space) in enumerate(self.colorTargets):
+                finders.append(functools.partial(labelCenters,labels,k+1,scale,y0))
+                colors[name] = self.columnsLight(255*counts[k+1],scale,w,h,stamp,finders[-1])
+                colorLights[2*k:2*k+2] = colors[name].lf_light,colors[name].rf_light
+            buffers.lend(labels,*finders)
+
         #Simplex Visual system -- overall 'light' in image, left/right light sensors and target 'angle'
-        m = cv2.moments(targetImage)
-        fract = m['m00']/iss
+        snap,columns = self.maskLight(targetImage,scale,y0,w,h,stamp,colors,colorLights)
+        self.publishLight(snap)
+        if self.recorder is not None and self.recordFeatures:
+            counts = np.zeros(w) # target pixels per frame column
+            part = np.repeat(columns*(scale/255.0),scale)[:w]
+            counts[:len(part)] = part
+            self.recorder.writeColumns(self.transport.now(),counts,w,h,self.targetCol)
+        if self.trigger=='frame':
+            self.triggerEvent.set()
+                
+        viz = self.viz
+        if viz is not None: # shown by the viewer process, as it was started
+            viz.frame(self.cameraImage if viz.options['camera'] else None,
+                      targetImage if viz.options['mask'] else None)
+        return
+
+    # the light snapshot of a 0/255 target mask (see visionFrame for scale
+    # and y0) of a w x h frame; also returns the column sums of the mask
+    def maskLight(self,mask,scale,y0,w,h,stamp,colors=None,colorLights=None):
+        columns = cv2.reduce(mask,0,cv2.REDUCE_SUM,dtype=cv2.CV_32S)[0]
+        #Complex Visual Systems - multiple objects, outputs target_centers
+        # when a behavior reads them
+        findCenters = functools.partial(maskCenters,mask,scale,y0)
+        snap = self.columnsLight(columns,scale,w,h,stamp,findCenters,colors,colorLights)
+        self.visionBuffers.lend(mask,findCenters)
+        return snap,columns
+
+    # the light snapshot from the column sums of a 0/255 target mask at
+    # 1/scale of a w x h frame: its m00 and m10 moments, scaled back to
+    # the whole frame
+    def columnsLight(self,columns,scale,w,h,stamp,findCenters,colors=None,colorLights=None):
+        m00 = float(columns.sum())
+        m10 = float(np.dot(columns,np.arange(len(columns),dtype=float)))
+        lightArray = None
+        if self.lightArrayCount:
+            lightArray = columnLights(columns*(scale*scale/255.0),self.lightArrayCount,w*h)
+        return self.lightSnapshot(m00*scale**2,m10*scale**3,w,h,(),stamp,findCenters,colors,colorLights,lightArray)
+
+    def columnLightArray(self,counts,pixels):
+        if not self.lightArrayCount:
+            return None
+        return columnLights(counts,self.lightArrayCount,pixels)
+
+    #Callback for the simulator camera, one row of pixel columns
+    @profiled
+    def callback_Columns(self,msg):
+        stamp=self.transport.now()
+        h,w = msg.height,msg.width
+        lo,hi = np.array(self.targetCol[0]),np.array(self.targetCol[1])
+        counts = columnCounts(msg,lambda colors:np.all((colors>=lo)&(colors<=hi),axis=-1))
+        colors,colorLights = {},None
+        if self.colorTargets:
+            colorLights = np.zeros(2*len(self.colorTargets))
+            for k,(name,cmin,cmax,space) in enumerate(self.colorTargets):
+                inside = lambda c:classifyColors(np.asarray(c,dtype=np.uint8),self.colorLut)==k+1
+                colorCounts = columnCounts(msg,inside)
+                colors[name] = self.lightSnapshot(255*colorCounts.sum(),255*np.dot(colorCounts,np.arange(w)),
+                                                  w,h,columnCenters(colorCounts,h),stamp,
+                                                  lightArray=self.columnLightArray(colorCounts,w*h))
+                colorLights[2*k:2*k+2] = colors[name].lf_light,colors[name].rf_light
+        # same moments as cv2.moments of the 0/255 target image
+        self.publishLight(self.lightSnapshot(255*counts.sum(),255*np.dot(counts,np.arange(w)),
+                                             w,h,columnCenters(counts,h),stamp,None,colors,colorLights,
+                                             self.columnLightArray(counts,w*h)))
+        if self.recorder is not None and self.recordFeatures:
+            self.recorder.writeColumns(self.transport.now(),counts,w,h,self.targetCol)
+        if self.trigger=='frame':
+            self.triggerEvent.set()
+        return
+
+    # log the laser, odometry, camera and motor commands of this vehicle to
+    # path, for brlog.Replay; frames='features' keeps only the target pixel
+    # count of each image column (what the light sensors are made from),
+    # frames='jpeg' keeps every camera frame as a JPEG
+    def recordSensors(self,path,frames='features'):
+        if frames not in ('features','jpeg'):
+            print("Braitenros: frames must be 'features' or 'jpeg', not ",frames)
+            return
+        self.stopRecording()
+        now = self.transport.now
+        topics = {'scan':self.laserTopic,'odom':self.poseTopic,'cmd':self.motionTopic}
+        if frames=='jpeg':
+            topics['image'] = self.imageTopic
+        else:
+            topics['columns'] = self.modelName+'/camera/columns'
+        recorder = brlog.Recorder(path,{'model':self.modelName,'simFlag':self.simFlag,'frames':frames,'topics':topics})
+        def odom(msg):
+            p = msg.pose.pose
+            recorder.writeOdom(now(),p.position.x,p.position.y,quaternionYaw(p.orientation))
+        self.recordSubs = [
+            self.transport.subscribe(self.laserTopic,LaserScan,lambda msg:recorder.writeScan(now(),msg)),
+            self.transport.subscribe(self.poseTopic,Odometry,odom),
+            self.transport.subscribe(self.motionTopic,Twist,lambda msg:recorder.writeCmd(now(),msg))]
+        if frames=='jpeg':
+            self.recordSubs.append(self.transport.subscribe(self.imageTopic,Image,
+                                   lambda img:recorder.writeJpeg(now(),imgmsgToBgr(img))))
+        self.recordFeatures = frames=='features'
+        self.recorder = recorder
+        self.transport.onShutdown(self.stopRecording)
+        return
+
+    def stopRecording(self):
+        if self.recorder is None:
+            return
+        for sub in self.recordSubs:
+            sub.unregister()
+        self.recorder.close()
+        print("Braitenros: "+str(self.recorder.count)+" sensor records written")
+        self.recorder=None
+        return
+
+    def publishLight(self,snap):
+        self.latestLight = snap
+        if not self.ticking:
+            self.light = snap
+        return
+
+    # the light sensors and target of a target image from its moments
+    def lightSnapshot(self,m00,m10,w,h,centers=(),stamp=None,findCenters=None,colors=None,colorLights=None,lightArray=None):
+        iss=h*w*1
+        fract = m00/iss
         
-        self.target_x=None
-        self.target_angle=None # absolute angle
+        target_x=None
+        target_angle=None # absolute angle
         FOV = 62.5 # FOV in degrees of Pi camera
-        self.lf_light,self.rf_light=0,0
+        lf_light,rf_light=0,0
         
         if fract>0: # skip if the target image has non nonzero regions
             # how far is the X center of target  from X center of image
-            delx = w/2 - m['m10']/m['m00']
+            delx = w/2 - m10/m00
             
-            self.target_x = float(m['m10']/m['m00']) # x coord of target
-            self.target_angle = math.degrees(self.Pose[2]) # robot pose
-            self.target_angle -= (FOV/float(w))*self.target_x - FOV/2.0
+            target_x = float(m10/m00) # x coord of target
+            target_angle = math.degrees(self.Pose[2]) # robot pose
+            target_angle -= (FOV/float(w))*target_x - FOV/2.0
             
             if delx<-10:
-                self.lf_light,self.rf_light = 0,int(fract)
+                lf_light,rf_light = 0,int(fract)
             elif delx>10:
-                self.lf_light,self.rf_light = int(fract),0
+                lf_light,rf_light = int(fract),0
             else:
-                self.lf_light,self.rf_light = int(fract/2),int(fract/2)
-                
-        if self.showLight: # some diagnostic capability
-            cv2.imshow('Target'+self.modelName,cv2.resize(targetImage,(320,240)))
-            cv2.waitKey(1)
-        return
+                lf_light,rf_light = int(fract/2),int(fract/2)
+        return LightSnapshot(stamp,lf_light,rf_light,target_x,target_angle,centers,findCenters,colors,colorLights,lightArray)
    
+    # change how many sectors the laser readings are split into
+    def setLaserSectors(self,n):
+        if n<4 or n%4!=0:
+            print("Laser sectors must be a multiple of 4, not ",n)
+            return
+        self.laserSectors=n
+        return
+
+    # where each quadrant's closest laser reading hit, in world coordinates
+    def contactPoints(self,laser=None):
+        if laser is None:
+            laser=self.latestLaser
+        inc=2*math.pi/len(laser.laserReadings) # angular inc per laser ray
+        x,y,yaw = self.Pose
+        angle = yaw+laser.mdi*inc
+        d = np.where(np.isinf(laser.mdq),0,laser.mdq)
+        return np.column_stack((x+d*np.cos(angle),y+d*np.sin(angle)))
+
     # set the names associated with each touch
     def setTouchedNames(self):
-        global multipleRobotList
-        mlen=len(self.laserReadings)
-        inc=2*math.pi/mlen # angular inc per laser ray
-        names=["","","",""]
-        threshold=0.1 # how close to check
-        for i in range(0,4): # check each touch to see if it was a robot
-            angle = self.mdi[i]*inc
-            d = self.mdq[i] if not math.isinf(self.mdq[i]) else 0
-            xd= d*math.cos(angle)+self.Pose[0]
-            yd= d*math.sin(angle)+self.Pose[1]
-            for v in multipleRobotList: # check each root to see if it was this one
-                if v!=self and np.hypot(xd-v.Pose[0],yd-v.Pose[1])<threshold:
-                    names[i]=v.name
-        # set the flags
-        self.lf_touched = names[0]
-        self.lb_touched = names[1]
-        self.rb_touched = names[2]
-        self.rf_touched = names[3]
+        rows = self.fleetPoses.nearest(self.contactPoints(),touchedThreshold,exclude=self.fleetRow)
+        self.setTouched(self.fleetPoses.namesOf(rows))
+        return
+
+    # set the flags, in a copy of the latest laser snapshot; under the
+    # laser lock, so a scan published meanwhile is not overwritten
+    def setTouched(self,names):
+        with self.laserLock:
+            snap = self.latestLaser.copy()
+            snap.lf_touched,snap.lb_touched,snap.rb_touched,snap.rf_touched = names[:4]
+            self.publishLaser(snap)
+        return
+
+    # hold laserLock when calling this
+    def publishLaser(self,snap):
+        self.latestLaser = snap
+        if not self.ticking:
+            self.laser = snap
         return
         
     #Callback to process laser data, sets the bumpers
+    @profiled
     def callback_Laser(self,msg):
         '''Call back function for laser range data'''
+        snap = LaserSnapshot.__new__(LaserSnapshot) # every field is set below
+        snap.stamp=self.transport.now()
         maxrange=10000
-        mlen = len(msg.ranges)
-        q = int(mlen/4)
-        # filter any ranges of zero as it pollutes min
-        self.laserReadings = [ r if (r>0 and not math.isnan(r)) else maxrange for r in msg.ranges ]
-        nzranges = self.laserReadings
+        ranges = np.asarray(msg.ranges) # no copy if it is an array already
+        # filter any ranges of zero or nan as they pollute min
+        snap.laserReadings = np.where(ranges>0,ranges,maxrange)
+        nzranges = snap.laserReadings
 
         #self.pmdq = self.mdq # take a backup
         #self.pmdi = self.mdi
-               
-        self.mdq[0] = np.nanmin(nzranges[0:q])
-        self.mdq[1] = np.nanmin(nzranges[q+1:2*q])
-        self.mdq[2] = np.nanmin(nzranges[2*q+1:3*q])
-        self.mdq[3] = np.nanmin(nzranges[3*q+1:mlen])
-        self.mdi[0] = np.nanargmin(nzranges[0:q])
-        self.mdi[1] = np.nanargmin(nzranges[q+1:2*q])
-        self.mdi[2] = np.nanargmin(nzranges[2*q+1:3*q])
-        self.mdi[3] = np.nanargmin(nzranges[3*q+1:mlen])
+
+        # min and its index for each sector, the sectors group into quadrants
+        n = self.laserSectors
+        pad = -len(nzranges)%n
+        if pad:
+            nzranges = np.concatenate((nzranges,np.full(pad,maxrange)))
+        sectors = nzranges.reshape(n,-1)
+        rows = np.arange(n)
+        mins = sectors.argmin(axis=1)
+        snap.sectorMin = sectors[rows,mins]
+        snap.sectorIndex = mins+rows*sectors.shape[1]
+        quads = snap.sectorMin.reshape(4,-1).argmin(axis=1)+np.arange(4)*(n//4)
+        mdq = snap.mdq = snap.sectorMin[quads]
+        snap.mdi = snap.sectorIndex[quads]
         '''
         # calculate contact velocities
         for i in range(0,4):
@@ -648,42 +1633,34 @@ class Braitenros():
         self.rb_moving = self.mdv[2]>moving_threshold
         self.rf_moving = self.mdv[3]>moving_threshold
         '''
-        self.setTouchedNames() # set the xx_touched member variables
+        # the names of the vehicles touched
+        rows = self.fleetPoses.nearest(self.contactPoints(snap),touchedThreshold,exclude=self.fleetRow)
+        snap.lf_touched,snap.lb_touched,snap.rb_touched,snap.rf_touched = self.fleetPoses.namesOf(rows)
         
         #include for backwards compatability
-        self.bumpLeft  = bool(self.mdq[0]<self.tooClose)
-        self.bumpRight = bool(self.mdq[3]<self.tooClose)
+        snap.bumpLeft  = bool(mdq[0]<self.tooClose)
+        snap.bumpRight = bool(mdq[3]<self.tooClose)
         
-        # set the contact flags
-        self.lf_touch,self.rf_touch,self.lb_touch,self.rb_touch=0,0,0,0
-        self.lf_detect,self.rf_detect,self.lb_detect,self.rb_detect=0,0,0,0
-        if self.mdq[0]<self.tooClose:
-            self.lf_touch=self.mdq[0] 
-        elif self.mdq[0]<self.not2Close:
-            self.lf_detect=self.mdq[0]    
-        if self.mdq[1]<self.tooClose:
-            self.lb_touch=self.mdq[1]
-        elif self.mdq[1]<self.not2Close:
-            self.lb_detect=self.mdq[1]
-        if self.mdq[2]<self.tooClose:
-            self.rb_touch=self.mdq[2]
-        elif self.mdq[2]<self.not2Close:
-            self.rb_detect=self.mdq[2]
-        if self.mdq[3]<self.tooClose:
-            self.rf_touch=self.mdq[3]
-        elif self.mdq[3]<self.not2Close:
-            self.rf_detect=self.mdq[3]
+        # set the contact flags, distance if touching/detecting else 0
+        touch = mdq<self.tooClose
+        detect = ~touch & (mdq<self.not2Close)
+        snap.lf_touch,snap.lb_touch,snap.rb_touch,snap.rf_touch = np.where(touch,mdq,0).tolist()
+        snap.lf_detect,snap.lb_detect,snap.rb_detect,snap.rf_detect = np.where(detect,mdq,0).tolist()
+        with self.laserLock:
+            self.publishLaser(snap)
         if self.showTouch:
-            print(" Touch LF,RF,LB,RB: {:.2f},{:.2f},{:.2f},{:.2f}".format(self.lf_touch,self.rf_touch, self.lb_touch, self.rb_touch))
-            print(" Detect LF,RF,LB,RB: {:.2f},{:.2f},{:.2f},{:.2f}".format(self.lf_detect,self.rf_detect, self.lb_detect, self.rb_detect))
+            print(" Touch LF,RF,LB,RB: {:.2f},{:.2f},{:.2f},{:.2f}".format(snap.lf_touch,snap.rf_touch, snap.lb_touch, snap.rb_touch))
+            print(" Detect LF,RF,LB,RB: {:.2f},{:.2f},{:.2f},{:.2f}".format(snap.lf_detect,snap.rf_detect, snap.lb_detect, snap.rb_detect))
+        if self.trigger=='scan':
+            self.triggerEvent.set()
         return
 
     #Move the robot to position x,y using odometry
     def goto(self,x,y):
         #
         threshold = 1.0
-        rate = rospy.Rate(20)
-        while not rospy.is_shutdown() and np.hypot(x-self.Pose[0],y-self.Pose[1])>threshold:
+        rate = self.transport.rate(20)
+        while not self.transport.isShutdown() and np.hypot(x-self.Pose[0],y-self.Pose[1])>threshold:
             delTheta = math.atan2(y-self.Pose[1], x-self.Pose[0]) - self.Pose[2]
             # check for angle 'wrapping around'
             if delTheta<-math.pi and self.Pose[2]>math.pi:
@@ -708,8 +1685,8 @@ class Braitenros():
             direction2go = -1 
         
         print ("Spinning to ",target_angle, " from ",self.Pose[2]," vgain= ",vgain)
-        rate=rospy.Rate(20)
-        while not rospy.is_shutdown() and adist>accuracy:
+        rate=self.transport.rate(20)
+        while not self.transport.isShutdown() and adist>accuracy:
             adist = abs(self.Pose[2]-target_angle)
             self.setVel(0.0,direction2go*vgain*adist)
             rate.sleep()
@@ -740,8 +1717,8 @@ class Braitenros():
     def look(self,turnFlag):    
         print(self.modelName," Looking..")
         cv2.namedWindow('Camera '+self.modelName, cv2.WINDOW_AUTOSIZE)
-        rate=rospy.Rate(10)
-        while not rospy.is_shutdown():
+        rate=self.transport.rate(10)
+        while not self.transport.isShutdown():
             if turnFlag:
                 self.setVel(0.0,0.1)
             else:
@@ -753,15 +1730,32 @@ class Braitenros():
             rate.sleep()
         return
 
+# the sensor values behaviors read (v.lf_touch, v.lf_light ..) come from
+# the snapshots bound for the current tick
+for name in LaserSnapshot.__slots__[1:]:
+    setattr(Braitenros,name,property(operator.attrgetter('laser.'+name)))
+for name in lightSensors:
+    setattr(Braitenros,name,property(operator.attrgetter('light.'+name)))
 
 
-#multiple behave does a threaded behave for every vehicle
+#multiple behave ticks every vehicle from one loop (brfleet.FleetScheduler),
+#or, with threaded=True, does a threaded behave for every vehicle
 #ends when they all end
 #
 
-def multipleBehave(vlist):
+def multipleBehave(vlist,threaded=False):
     global multipleRobotList
     multipleRobotList=vlist
+    if not threaded and not all(v.transport is vlist[0].transport for v in vlist):
+        print("Braitenros: vehicles use different transports, behaving in threads")
+        threaded=True
+    if not threaded:
+        for v in vlist:
+            v.showBehavior=False
+        scheduler=brfleet.FleetScheduler(vlist,vlist[0].transport)
+        scheduler.run()
+        scheduler.report()
+        return scheduler
     threadList=[]
     for v in vlist:
         t = threading.Thread(target=v.behave, args=(v.showCamera,v.showTouch,v.showLight,v.showPose))
@@ -775,17 +1769,40 @@ def multipleBehave(vlist):
     #    v.callback_Shutdown()
     return
    
-# multiplePlot will plot all the robot positions on  one graph
+# multipleProcessBehave runs the vehicles made by each factory in its own
+# worker process (see brfleet.ProcessFleet); factories are functions, e.g.
+#   def group1():
+#       v=Braitenros(name="blue")
+#       v.addBehavior(wander)
+#       return [v]
+# returns the brfleet.FleetScheduler stats of every process
+#
+def multipleProcessBehave(factories,rowsPerWorker=64):
+    fleet=brfleet.ProcessFleet(factories,rowsPerWorker)
+    return fleet.run()
+
+# set the touched names of every vehicle with one query of the pose table
+# (one per table, if the vehicles are on different transports)
 #
-def multiplePlotPosition(vlist):
+def setFleetTouchedNames(vlist):
+    tables = {}
     for v in vlist:
-        plt.scatter(v.poseListX, v.poseListY, marker=".")
-    plt.title("Robot position")
-    plt.xlabel("X")
-    plt.ylabel("Y")
-    print("The program will not continue until you kill the plot window")
-    plt.show()
+        tables.setdefault(id(v.fleetPoses),[]).append(v)
+    for group in tables.values():
+        table = group[0].fleetPoses
+        points = np.concatenate([v.contactPoints() for v in group])
+        exclude = np.repeat([v.fleetRow for v in group],4)
+        names = table.namesOf(table.nearest(points,touchedThreshold,exclude))
+        for i,v in enumerate(group):
+            v.setTouched(names[4*i:4*i+4])
     return
+
+# multiplePlot will plot all the robot positions on  one graph, in a
+# separate process, or written to path (.png, .svg ..) if given
+#
+def multiplePlotPosition(vlist,path=None):
+    prepared = brplot.preparePositions([(v.modelName,v.poseListX,v.poseListY) for v in vlist])
+    return brplot.output(prepared,path)
   
    
 #----------------------------------END-----------------------------
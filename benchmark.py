@@ -0,0 +1,231 @@
+#
+# BRAITENROS benchmarks
+# Times the vehicle callbacks and behavior machinery on synthetic sensor
+# messages, without ROS, and writes the results as JSON so that two
+# commits can be compared:
+#
+#   python3 benchmark.py -o before.json
+#   ... change something ...
+#   python3 benchmark.py -o after.json
+#   python3 benchmark.py --compare before.json after.json
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import cv2
+
+import brtransport
+import BBbraitenrosT3 as br
+
+#
+# synthetic messages
+#
+
+# a 360 ray scan of a square room of half width room, seen from x,y,yaw,
+# with noise and some zero (no return) readings
+def makeScan(rng,x=0.0,y=0.0,yaw=0.0,room=2.0,rays=360):
+    angles = yaw+np.arange(rays)*2*math.pi/rays
+    c,s = np.cos(angles),np.sin(angles)
+    with np.errstate(divide='ignore'):
+        tx = np.where(c>0,(room-x)/c,np.where(c<0,(-room-x)/c,np.inf))
+        ty = np.where(s>0,(room-y)/s,np.where(s<0,(-room-y)/s,np.inf))
+    ranges = np.minimum(tx,ty)+rng.normal(0,0.01,rays)
+    ranges[rng.random(rays)<0.02] = 0.0
+    msg = brtransport.LaserScan(ranges.astype(np.float32))
+    msg.angle_increment = 2*math.pi/rays
+    msg.range_max = 3.5
+    return msg
+
+# a gray camera frame with a white target rectangle and some noise
+def makeImage(rng,w,h):
+    frame = np.full((h,w,3),90,dtype=np.uint8)
+    x0,y0 = int(rng.integers(0,w//2)),int(rng.integers(h//4,h//2))
+    frame[y0:y0+h//4,x0:x0+w//5] = 230
+    noise = rng.integers(0,20,(h,w,1),dtype=np.uint8)
+    frame = cv2.add(frame,np.repeat(noise,3,axis=2))
+    return brtransport.Image(h,w,'bgr8',3*w,frame.tobytes())
+
+def makeOdom(x,y,yaw):
+    msg = brtransport.Odometry()
+    msg.pose.pose.position.x = x
+    msg.pose.pose.position.y = y
+    msg.pose.pose.orientation.z = math.sin(yaw/2)
+    msg.pose.pose.orientation.w = math.cos(yaw/2)
+    return msg
+
+#
+# timing
+#
+
+# call f(i) for i in range(n) after warmup calls; per call statistics
+def timeCalls(f,n,warmup=20):
+    for i in range(warmup):
+        f(i)
+    times = np.empty(n)
+    clock = time.perf_counter
+    for i in range(n):
+        start = clock()
+        f(i)
+        times[i] = clock()-start
+    return {'n':n,'perSecond':n/times.sum(),
+            'mean':float(times.mean()),'p50':float(np.percentile(times,50)),
+            'p90':float(np.percentile(times,90)),'p99':float(np.percentile(times,99)),
+            'max':float(times.max())}
+
+def quietly(f,*args,**kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return f(*args,**kwargs)
+
+def makeVehicle(transport,name):
+    v = quietly(br.Braitenros,modelName=name,name=name,transport=transport)
+    v.showBehavior = False
+    return v
+
+#
+# the benchmarks, each returns name -> statistics
+#
+
+def benchLaser(rng,n):
+    v = makeVehicle(brtransport.LocalTransport(),"bench")
+    scans = [makeScan(rng,*rng.uniform(-1,1,2),rng.uniform(-3,3)) for k in range(50)]
+    return {'callback_Laser':timeCalls(lambda i:v.callback_Laser(scans[i%len(scans)]),n)}
+
+def benchImage(rng,n):
+    v = makeVehicle(brtransport.LocalTransport(),"bench")
+    out = {}
+    for w,h in ((320,240),(640,480),(1280,720)):
+        frames = [makeImage(rng,w,h) for k in range(8)]
+        out['callback_Image_{}x{}'.format(w,h)] = timeCalls(lambda i:v.callback_Image(frames[i%len(frames)]),
+                                                             max(10,n*320*240//(w*h)))
+    # two more target colors, found through the color lookup table
+    v.addColorTarget('red',(0,0,150),(80,80,255))
+    v.addColorTarget('green',(35,100,100),(85,255,255),space='hsv')
+    frames = [makeImage(rng,640,480) for k in range(8)]
+    out['callback_Image_640x480_colors'] = timeCalls(lambda i:v.callback_Image(frames[i%len(frames)]),n//4)
+    return out
+
+def benchTouched(rng,n):
+    out = {}
+    for size in (1,10,50,200):
+        transport = brtransport.LocalTransport()
+        fleet = [makeVehicle(transport,"v{}".format(k)) for k in range(size)]
+        for v in fleet:
+            v.callback_Pose(makeOdom(*rng.uniform(-3,3,2),rng.uniform(-3,3)))
+            v.callback_Laser(makeScan(rng,*v.Pose))
+        def move(i):
+            v = fleet[i%size] # one odometry update per call, as in a running fleet
+            v.callback_Pose(makeOdom(v.Pose[0]+0.001,v.Pose[1],v.Pose[2]))
+            v.setTouchedNames()
+        out['setTouchedNames_fleet{}'.format(size)] = timeCalls(move,n)
+        fleetNames = lambda i:br.setFleetTouchedNames(fleet)
+        out['setFleetTouchedNames_fleet{}'.format(size)] = timeCalls(fleetNames,max(10,n//size))
+    return out
+
+def benchConnections(rng,n):
+    v = makeVehicle(brtransport.LocalTransport(),"bench")
+    v.callback_Laser(makeScan(rng))
+    for source,sink in ((v.vleft_connect,v.lf_touch_connect),(v.vleft_connect,v.rf_light_connect),
+                        (v.vright_connect,v.rf_touch_connect),(v.vright_connect,v.lf_light_connect)):
+        v.connect(source,sink)
+    return {'doConnections':timeCalls(lambda i:v.doConnections(False),n)}
+
+# a priority list nested depth deep: [b0,[b1,[b2,...]]], every behavior
+# not released so that the whole tree is walked
+def behaviorTree(depth):
+    def make(k):
+        def behavior(v):
+            v.vleft += 0.001
+            return not br.Released
+        behavior.__name__ = "b{}".format(k)
+        return behavior
+    tree = [make(depth-1)]
+    for k in range(depth-2,-1,-1):
+        tree = [make(k),tree]
+    return tree
+
+def benchBehaviors(rng,n):
+    out = {}
+    for depth in (1,4,16,64):
+        v = makeVehicle(brtransport.LocalTransport(),"bench")
+        tree = behaviorTree(depth)
+        quietly(v.addBehavior,tree)
+        for b in v.slotBehaviors:
+            v.setBehaviorRate(b) # every tick, no skips
+        out['doBB_depth{}'.format(depth)] = timeCalls(lambda i:v.doBB(tree),n)
+        out['doPlan_depth{}'.format(depth)] = timeCalls(lambda i:v.doPlan(0.0,0.0),n)
+    return out
+
+benchmarks = {'laser':benchLaser,'image':benchImage,'touched':benchTouched,
+              'connections':benchConnections,'behaviors':benchBehaviors}
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def run(names,n,seed):
+    results = {}
+    for name in names:
+        rng = np.random.default_rng(seed)
+        start = time.time()
+        results.update(benchmarks[name](rng,n))
+        print("{:>12}: {:.1f}s".format(name,time.time()-start),file=sys.stderr)
+    return {'commit':gitCommit(),'time':time.time(),'python':platform.python_version(),
+            'numpy':np.__version__,'opencv':cv2.__version__,'machine':platform.machine(),
+            'n':n,'seed':seed,'results':results}
+
+def show(report):
+    print("{:<34}{:>10}{:>10}{:>10}{:>10}{:>12}".format("","p50 us","p90 us","p99 us","max us","per second"))
+    for name,r in report['results'].items():
+        print("{:<34}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.0f}".format(
+            name,1e6*r['p50'],1e6*r['p90'],1e6*r['p99'],1e6*r['max'],r['perSecond']))
+    return
+
+# p50 of the second file against the first, > 1 is slower
+def compare(before,after):
+    a,b = before['results'],after['results']
+    print("{} -> {}".format(before.get('commit'),after.get('commit')))
+    print("{:<34}{:>12}{:>12}{:>8}".format("","p50 us","p50 us","ratio"))
+    for name in a:
+        if name in b:
+            ratio = b[name]['p50']/a[name]['p50']
+            flag = "  slower" if ratio>1.1 else ("  faster" if ratio<0.9 else "")
+            print("{:<34}{:>12.1f}{:>12.1f}{:>8.2f}{}".format(name,1e6*a[name]['p50'],1e6*b[name]['p50'],ratio,flag))
+    return
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Braitenros benchmarks")
+    parser.add_argument('-o','--output',default="benchmark.json",help="JSON results file")
+    parser.add_argument('-n',type=int,default=2000,help="calls per benchmark")
+    parser.add_argument('--seed',type=int,default=1)
+    parser.add_argument('--only',nargs='*',choices=sorted(benchmarks),help="run only these")
+    parser.add_argument('--compare',nargs=2,metavar=('BEFORE','AFTER'),help="compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before,after)
+        sys.exit(0)
+    report = run(args.only or list(benchmarks),args.n,args.seed)
+    with open(args.output,'w') as f:
+        json.dump(report,f,indent=1)
+    show(report)
+    print("Results written to "+args.output)
@@ -0,0 +1,470 @@
+#
+# BRAITENROS fleet support
+# Shared state for many vehicles in one program, and a scheduler that
+# runs them all from one loop
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import asyncio
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+
+#
+# FleetPoseTable: one row x,y,yaw per vehicle in a single array. Each
+# vehicle only writes its own row (from callback_Pose), as one slice
+# assignment, so readers never see a half written pose. A uniform grid
+# over the poses answers 'which vehicle is near this point' for a batch
+# of points at once; the grid is rebuilt only when a pose has changed.
+#
+# A table made by FleetPoseTable.shared() keeps its arrays (poses, names,
+# a change counter per row and a blackboard of boardSize values per
+# vehicle) in one multiprocessing.shared_memory block, so vehicles in
+# other processes (see ProcessFleet) see each other without any pickling.
+# Each process registers into its own range of rows. Rows written from
+# another process can be read mid update; a pose is then a mix of two
+# consecutive odometry messages, which is harmless here.
+# ----------------------------------------------
+
+keyBase = 1<<21 # grid cells are packed as cx*keyBase+cy
+cellOffsets = np.array([dx*keyBase+dy for dx in (-1,0,1) for dy in (-1,0,1)],dtype=np.int64)
+nameBytes = 32 # longest vehicle name in a shared table
+boardSize = 8 # shared values per vehicle
+
+class FleetPoseTable():
+
+    def __init__(self,capacity=64,cellSize=0.25,memory=None,rowBase=0,rowLimit=None):
+        self.cellSize = cellSize
+        self.memory = memory # SharedMemory, or None for a table of this process
+        if memory is None:
+            self.poses = np.full((capacity,3),np.nan) # nan until the first odometry
+            self.versions = np.zeros(capacity,dtype=np.int64) # bumped by every update
+            self.board = np.full((capacity,boardSize),np.nan)
+            self.nameTable = None
+        else:
+            self.mapArrays(capacity)
+        self.names = [] # names of the rows registered here, from rowBase
+        self.rowBase = rowBase
+        self.rowLimit = rowLimit if rowLimit is not None else capacity
+        self.indexVersion = -1
+        self.indexCell = None
+        self.lock = threading.Lock() # only for adding vehicles
+
+    # bytes of shared memory for a table of capacity rows
+    @staticmethod
+    def sharedSize(capacity):
+        return capacity*(8*3+8+nameBytes+8*boardSize)
+
+    def mapArrays(self,capacity):
+        buf = self.memory.buf
+        at = 0
+        self.poses = np.ndarray((capacity,3),np.float64,buf,at); at += 8*3*capacity
+        self.versions = np.ndarray(capacity,np.int64,buf,at); at += 8*capacity
+        self.nameTable = np.ndarray((capacity,nameBytes),np.uint8,buf,at); at += nameBytes*capacity
+        self.board = np.ndarray((capacity,boardSize),np.float64,buf,at)
+        return
+
+    # a new table in shared memory, for a fleet spread over processes
+    @classmethod
+    def shared(cls,capacity,cellSize=0.25):
+        from multiprocessing import shared_memory
+        memory = shared_memory.SharedMemory(create=True,size=cls.sharedSize(capacity))
+        table = cls(capacity,cellSize,memory)
+        table.poses[:] = np.nan
+        table.versions[:] = 0
+        table.nameTable[:] = 0
+        table.board[:] = np.nan
+        return table
+
+    # the same table in another process, registering rows from rowBase on
+    @classmethod
+    def attach(cls,name,capacity,rowBase,rowLimit,cellSize=0.25):
+        from multiprocessing import shared_memory
+        memory = shared_memory.SharedMemory(name=name)
+        return cls(capacity,cellSize,memory,rowBase,rowLimit)
+
+    def close(self,unlink=False):
+        if self.memory is not None:
+            self.poses = self.versions = self.nameTable = self.board = None
+            self.memory.close()
+            if unlink:
+                self.memory.unlink()
+            self.memory = None
+        return
+
+    # add a vehicle, returns its row
+    def register(self,name):
+        with self.lock:
+            row = self.rowBase+len(self.names)
+            if row>=self.rowLimit:
+                if self.memory is not None:
+                    raise ValueError("shared fleet table is full")
+                self.grow()
+            self.names.append(name)
+            if self.nameTable is not None:
+                data = name.encode()[:nameBytes]
+                self.nameTable[row] = 0
+                self.nameTable[row,:len(data)] = np.frombuffer(data,np.uint8)
+        return row
+
+    # the vehicle in row has stopped: it is no longer near anything or
+    # found by name (the row is not used again)
+    def unregister(self,row):
+        with self.lock:
+            if self.poses is None: # a shared table that has been closed
+                return
+            self.poses[row] = np.nan
+            self.board[row] = np.nan
+            self.versions[row] += 1
+            self.names[row-self.rowBase] = ""
+            if self.nameTable is not None:
+                self.nameTable[row] = 0
+        return
+
+    def grow(self):
+        n = len(self.poses)
+        self.poses = np.concatenate((self.poses,np.full((n,3),np.nan)))
+        self.versions = np.concatenate((self.versions,np.zeros(n,dtype=np.int64)))
+        self.board = np.concatenate((self.board,np.full((n,boardSize),np.nan)))
+        self.rowLimit = 2*n
+        return
+
+    def update(self,row,x,y,yaw):
+        self.poses[row] = (x,y,yaw)
+        self.versions[row] += 1 # only this row's owner writes it
+        return
+
+    def count(self):
+        return len(self.names)
+
+    # changes so far, summed over rows so that no two writers share a counter
+    def version(self):
+        return int(self.versions.sum())
+
+    def nameOf(self,row):
+        if row<0:
+            return ""
+        if self.nameTable is None:
+            return self.names[row]
+        return self.nameTable[row].tobytes().rstrip(b"\0").decode()
+
+    # row of the vehicle with this name, -1 if there is none
+    def rowOf(self,name):
+        if self.nameTable is None:
+            return self.names.index(name) if name in self.names else -1
+        raw = name.encode()[:nameBytes]
+        if not raw: # unnamed vehicles cannot be told apart
+            return -1
+        data = np.zeros(nameBytes,np.uint8)
+        data[:len(raw)] = np.frombuffer(raw,np.uint8)
+        rows = np.flatnonzero((self.nameTable==data).all(axis=1))
+        return int(rows[0]) if len(rows) else -1
+
+    # sort the known poses by grid cell
+    def buildIndex(self,cell):
+        poses = self.poses.copy() # one picture of the fleet, unused rows are nan
+        rows = np.flatnonzero(~np.isnan(poses[:,0]))
+        cx = np.floor(poses[rows,0]/cell).astype(np.int64)
+        cy = np.floor(poses[rows,1]/cell).astype(np.int64)
+        keys = cx*keyBase+cy
+        order = np.argsort(keys,kind='stable')
+        self.indexKeys = keys[order]
+        self.indexRows = rows[order]
+        self.indexPoses = poses
+        self.indexCell = cell
+        # most vehicles that share one cell, bounds the gather loop below
+        counts = np.unique(self.indexKeys,return_counts=True)[1]
+        self.indexDepth = int(counts.max()) if len(counts) else 0
+        return
+
+    # for each point (P,2) the row of the closest vehicle within threshold,
+    # or -1; exclude (scalar or (P,)) is a row that must not match,
+    # e.g. the vehicle whose laser produced the point
+    def nearest(self,points,threshold,exclude=-1):
+        points = np.asarray(points,dtype=float).reshape(-1,2)
+        cell = max(threshold,self.cellSize)
+        version = self.version()
+        if self.indexVersion!=version or self.indexCell!=cell:
+            self.indexVersion = version
+            self.buildIndex(cell)
+        best = np.full(len(points),-1)
+        bestD = np.full(len(points),threshold)
+        if self.indexDepth==0:
+            return best
+        exclude = np.broadcast_to(exclude,len(points))[:,None]
+        px = np.floor(points[:,0]/cell).astype(np.int64)
+        py = np.floor(points[:,1]/cell).astype(np.int64)
+        # the 3x3 cells around each point, (P,9)
+        keys = (px*keyBase+py)[:,None]+cellOffsets
+        start = np.searchsorted(self.indexKeys,keys,'left')
+        end = np.searchsorted(self.indexKeys,keys,'right')
+        last = len(self.indexRows)-1
+        for j in range(self.indexDepth): # j-th vehicle of each cell
+            at = start+j
+            rows = self.indexRows[np.minimum(at,last)]
+            pose = self.indexPoses[rows]
+            d = np.hypot(points[:,0:1]-pose[:,:,0],points[:,1:2]-pose[:,:,1])
+            d[(at>=end)|(rows==exclude)] = np.inf
+            k = d.argmin(axis=1)
+            dk = d[np.arange(len(points)),k]
+            better = dk<bestD
+            best = np.where(better,rows[np.arange(len(points)),k],best)
+            bestD = np.where(better,dk,bestD)
+        return best
+
+    # names for the rows from nearest, "" for -1
+    def namesOf(self,rows):
+        return [self.nameOf(r) for r in rows]
+
+#
+# FleetScheduler: ticks many vehicles from one loop instead of one thread
+# per vehicle. Every vehicle is due at multiples of its own period
+# (1/v.rate, or rates[i]) on the transport clock; vehicles due at the same
+# time tick in list order. A tick that ends after the vehicle's next due
+# time is an overrun: the missed ticks are skipped, as rospy.Rate does.
+#
+# A vehicle with a trigger (v.setTrigger) ticks as it would in its own
+# behave(): when its sensor has new data, at most v.maxRate times a
+# second, and at its rate if the sensor goes quiet. Its trigger event is
+# swapped for a FleetTrigger, which also wakes the loop.
+#
+# run() blocks; runAsync() is the same loop as an asyncio coroutine, so
+# other tasks can share the thread. A vehicle that stops (e.g. out of
+# bounds) leaves the schedule; the loop ends when none are left or the
+# transport shuts down.
+# ----------------------------------------------
+
+class FleetTrigger(threading.Event):
+
+    def __init__(self,wake):
+        super().__init__()
+        self.wake = wake
+
+    def set(self):
+        super().set()
+        self.wake.set()
+        return
+
+class FleetScheduler():
+    eventPoll = 0.002 # seconds, runAsync on a real clock checks triggers this often
+
+    def __init__(self,vehicles,transport,rates=None):
+        self.vehicles = list(vehicles)
+        self.transport = transport
+        if rates is None:
+            rates = [v.rate for v in self.vehicles]
+        self.periods = [1.0/r for r in rates]
+        n = len(self.vehicles)
+        self.due = np.zeros(n) # next tick time of each vehicle
+        self.active = np.zeros(n,dtype=bool)
+        self.ticks = np.zeros(n,dtype=np.int64)
+        self.overruns = np.zeros(n,dtype=np.int64)
+        self.tickTime = np.zeros(n) # wall seconds spent ticking
+        self.maxTickTime = np.zeros(n)
+        self.maxLate = np.zeros(n) # worst start after the due time
+        self.triggered = [i for i,v in enumerate(self.vehicles) if v.trigger is not None]
+        self.minPeriods = np.zeros(n) # triggered: 1/maxRate
+        self.last = np.zeros(n) # triggered: start of the last tick
+        self.wake = threading.Event() # set by any FleetTrigger
+
+    def start(self):
+        now = self.transport.now()
+        for i,v in enumerate(self.vehicles):
+            v.startBehavior(v.showCamera,v.showTouch,v.showLight,v.showPose)
+            self.due[i] = now
+            self.active[i] = True
+        for i in self.triggered:
+            v = self.vehicles[i]
+            v.triggerEvent = FleetTrigger(self.wake)
+            self.minPeriods[i] = 1.0/v.maxRate
+            self.last[i] = now-self.periods[i] # first tick now, as in behave()
+        return
+
+    # a triggered vehicle is due 1/maxRate after its last tick if its
+    # sensor has new data, else a period after it
+    def triggerDue(self):
+        self.wake.clear() # before the events are read, so none is missed
+        for i in self.triggered:
+            ready = self.vehicles[i].triggerEvent.is_set()
+            self.due[i] = self.last[i]+(self.minPeriods[i] if ready else self.periods[i])
+        return
+
+    # seconds until the next vehicle is due, None when all have stopped
+    def nextWait(self):
+        if not self.active.any() or self.transport.isShutdown():
+            return None
+        self.triggerDue()
+        return max(0.0,self.due[self.active].min()-self.transport.now())
+
+    # wait seconds, or until a triggered vehicle's sensor has new data
+    def wait(self,seconds):
+        if self.triggered:
+            self.transport.waitEvent(self.wake,seconds)
+        else:
+            self.transport.sleep(seconds)
+        return
+
+    # tick every vehicle that is due
+    def tickDue(self):
+        transport = self.transport
+        self.triggerDue()
+        for i in np.flatnonzero(self.active&(self.due<=transport.now()+1e-9)):
+            v = self.vehicles[i]
+            self.maxLate[i] = max(self.maxLate[i],transport.now()-self.due[i])
+            if v.trigger is not None:
+                v.triggerEvent.clear()
+                self.last[i] = transport.now()
+            start = time.perf_counter()
+            try:
+                v.tick()
+            except transport.InterruptException:
+                self.active[i] = False
+                v.stopBehavior()
+                continue
+            spent = time.perf_counter()-start
+            self.tickTime[i] += spent
+            self.maxTickTime[i] = max(self.maxTickTime[i],spent)
+            self.ticks[i] += 1
+            if v.trigger is not None:
+                continue # due again when its sensor has data
+            self.due[i] += self.periods[i]
+            if self.due[i]<transport.now():
+                self.overruns[i] += 1
+                self.due[i] = transport.now()
+        return
+
+    def stop(self):
+        for i in np.flatnonzero(self.active):
+            self.active[i] = False
+            self.vehicles[i].stopBehavior()
+        return
+
+    def run(self):
+        self.start()
+        try:
+            while True:
+                wait = self.nextWait()
+                if wait is None:
+                    break
+                if wait>0:
+                    self.wait(wait)
+                self.tickDue()
+        except self.transport.InterruptException:
+            pass
+        self.stop()
+        return
+
+    async def runAsync(self):
+        self.start()
+        try:
+            while True:
+                wait = self.nextWait()
+                if wait is None:
+                    break
+                if self.transport.isLocal: # simulated clock, just let others run
+                    self.wait(wait)
+                    await asyncio.sleep(0)
+                elif self.triggered:
+                    await asyncio.sleep(min(wait,self.eventPoll))
+                else:
+                    await asyncio.sleep(wait)
+                self.tickDue()
+        except self.transport.InterruptException:
+            pass
+        self.stop()
+        return
+
+    # per vehicle: name, rate, ticks, overruns, mean and max tick time and
+    # the latest start (seconds)
+    def stats(self):
+        out = []
+        for i,v in enumerate(self.vehicles):
+            out.append({'name':v.modelName,'rate':1.0/self.periods[i],'ticks':int(self.ticks[i]),
+                        'overruns':int(self.overruns[i]),
+                        'meanTick':self.tickTime[i]/max(1,self.ticks[i]),
+                        'maxTick':float(self.maxTickTime[i]),'maxLate':float(self.maxLate[i])})
+        return out
+
+    def report(self):
+        for st in self.stats():
+            print("{name:>4}: {ticks} ticks at {rate:g} Hz, {overruns} overruns, tick {meanTick:.2e}s mean {maxTick:.2e}s max".format(**st))
+        return
+
+#
+# ProcessFleet: runs groups of vehicles in worker processes, one process
+# per factory. Vehicles cannot move between processes (they hold
+# subscriptions), so each factory is a function, importable by name, that
+# makes its vehicles (one or a list) inside the worker; the worker then
+# runs them with multipleBehave. The pose table, and so the touched names
+# and the blackboard, is shared memory, one range of rows per worker.
+#
+# On ROS every worker is its own (anonymous) node. With brsim every
+# worker runs its own simulator: robots of other workers are known by
+# their poses, but are not seen by the simulated laser.
+#
+#   fleet = brfleet.ProcessFleet([groupA,groupB,groupC])
+#   results = fleet.run() # per worker: the scheduler stats
+#
+# The workers are started with 'spawn' (method), so none of them inherits
+# the threads or ROS connection of the parent; the program that runs the
+# fleet needs the if __name__=="__main__": guard.
+# ----------------------------------------------
+
+def fleetWorker(factory,tableName,capacity,rowBase,rowLimit,threaded):
+    import BBbraitenrosT3 as br # imported here, it imports this module
+    import brtransport
+    brtransport.RosTransport.anonymous = True
+    table = FleetPoseTable.attach(tableName,capacity,rowBase,rowLimit)
+    br.fleetPoses = table
+    br.modelIndex = rowBase # vehicles without a modelName get namespaces no other worker uses
+    try:
+        vehicles = factory()
+        if not isinstance(vehicles,(list,tuple)):
+            vehicles = [vehicles]
+        scheduler = br.multipleBehave(list(vehicles),threaded=threaded)
+        # the rows are emptied as the vehicles shut down, so their last
+        # poses go back with the stats
+        last = [(v.fleetRow,v.Pose) for v in vehicles]
+        return (scheduler.stats() if scheduler is not None else []),last
+    finally:
+        br.fleetPoses = None
+        table.close()
+
+class ProcessFleet():
+
+    # rowsPerWorker: most vehicles a factory may make
+    def __init__(self,factories,rowsPerWorker=64,threaded=False,method='spawn'):
+        self.factories = list(factories)
+        self.rowsPerWorker = rowsPerWorker
+        self.threaded = threaded
+        self.context = multiprocessing.get_context(method)
+        self.table = None
+
+    def run(self):
+        n = len(self.factories)
+        capacity = n*self.rowsPerWorker
+        self.table = FleetPoseTable.shared(capacity)
+        try:
+            with self.context.Pool(n,maxtasksperchild=1) as pool:
+                jobs = [pool.apply_async(fleetWorker,(factory,self.table.memory.name,capacity,
+                                                      i*self.rowsPerWorker,(i+1)*self.rowsPerWorker,
+                                                      self.threaded))
+                        for i,factory in enumerate(self.factories)]
+                results = [job.get() for job in jobs]
+            self.poses = np.full((capacity,3),np.nan) # last pose of every row
+            for stats,last in results:
+                for row,pose in last:
+                    self.poses[row] = pose
+        finally:
+            self.table.close(unlink=True)
+            self.table = None
+        return [stats for stats,last in results]
+
+#----------------------------------END-----------------------------
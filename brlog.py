@@ -0,0 +1,279 @@
+#
+# BRAITENROS sensor logs
+# Record the sensor data that drives a vehicle (laser, odometry, camera)
+# and the motor commands it sent, and replay a log through the same
+# callbacks and behave() loop on the simulated clock
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import json
+import math
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+import brtransport
+
+#
+# File layout: the magic line, one line of JSON (topics and model name),
+# then records of
+#   type (1 byte), time (float64 seconds), payload length (uint32), payload
+#
+# scan    angle_min, angle_increment, range_max (float32), ranges as
+#         uint16 millimeters (65535 = inf), zlib compressed
+# odom    x, y, yaw (float64)
+# columns image height, width (uint16), target color bounds (6 x uint8),
+#         target pixels of each image column (float32), zlib compressed;
+#         the light features, enough to set the light sensors on replay
+# jpeg    a JPEG encoded camera frame
+# cmd     linear x, angular z (float64) sent on cmd_vel
+#
+# Usage, on the robot:
+#   v.recordSensors("run1.brlog")       # or frames='jpeg'
+#   v.behave()
+# and later, without the robot:
+#   replay = brlog.Replay("run1.brlog")
+#   v = replay.vehicle()                # a Braitenros fed by the log
+#   ... same behaviors ...
+#   v.behave()                          # as fast as the CPU allows
+#   t,logged,replayed = replay.compare()
+# ----------------------------------------------
+
+magic = b"BRAITENROS-LOG 1\n"
+recordHeader = struct.Struct('<BdI')
+scanHeader = struct.Struct('<fffI')
+columnsHeader = struct.Struct('<HH6B')
+
+SCAN,ODOM,COLUMNS,JPEG,CMD = 1,2,3,4,5
+timeSlack = 1e-6 # seconds, replay and log clocks add up periods differently
+
+class Recorder():
+
+    def __init__(self,path,meta):
+        self.file = open(path,'wb')
+        self.file.write(magic)
+        self.file.write(json.dumps(meta).encode()+b"\n")
+        self.lock = threading.Lock() # callbacks come from several threads
+        self.count = 0
+
+    def write(self,kind,t,payload):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(recordHeader.pack(kind,t,len(payload)))
+            self.file.write(payload)
+            self.count += 1
+        return
+
+    def writeScan(self,t,msg):
+        ranges = np.asarray(msg.ranges,dtype=np.float64)
+        mm = np.round(np.nan_to_num(ranges,nan=0.0,posinf=65.535)*1000.0)
+        mm = np.clip(mm,0,65535).astype('<u2')
+        head = scanHeader.pack(msg.angle_min,msg.angle_increment,msg.range_max,len(mm))
+        self.write(SCAN,t,head+zlib.compress(mm.tobytes(),1))
+        return
+
+    def writeOdom(self,t,x,y,yaw):
+        self.write(ODOM,t,struct.pack('<ddd',x,y,yaw))
+        return
+
+    # counts: target pixels per image column
+    def writeColumns(self,t,counts,w,h,targetCol):
+        counts = np.asarray(counts,dtype='<f4') # simulated columns are fractional
+        head = columnsHeader.pack(h,w,*(tuple(targetCol[0])+tuple(targetCol[1])))
+        self.write(COLUMNS,t,head+zlib.compress(counts.tobytes(),1))
+        return
+
+    def writeJpeg(self,t,frame,quality=80):
+        import cv2
+        ok,data = cv2.imencode('.jpg',frame,[cv2.IMWRITE_JPEG_QUALITY,quality])
+        if ok:
+            self.write(JPEG,t,data.tobytes())
+        return
+
+    def writeCmd(self,t,msg):
+        self.write(CMD,t,struct.pack('<dd',msg.linear.x,msg.angular.z))
+        return
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        return
+
+# read a log: returns the meta data and a list of (type,time,payload)
+def readLog(path):
+    with open(path,'rb') as f:
+        if f.readline()!=magic:
+            raise ValueError(path+" is not a braitenros log")
+        meta = json.loads(f.readline())
+        data = f.read()
+    records = []
+    at = 0
+    while at+recordHeader.size<=len(data):
+        kind,t,n = recordHeader.unpack_from(data,at)
+        at += recordHeader.size
+        if at+n>len(data):
+            break # cut short, e.g. the robot lost power
+        records.append((kind,t,data[at:at+n]))
+        at += n
+    return meta,records
+
+def decodeScan(payload):
+    amin,ainc,rmax,n = scanHeader.unpack_from(payload)
+    mm = np.frombuffer(zlib.decompress(payload[scanHeader.size:]),dtype='<u2')
+    ranges = mm/1000.0
+    ranges[mm==65535] = np.inf
+    msg = brtransport.LaserScan(ranges)
+    msg.angle_min,msg.angle_increment = amin,ainc
+    msg.angle_max = amin+ainc*(n-1)
+    msg.range_max = rmax
+    return msg
+
+def decodeOdom(payload):
+    x,y,yaw = struct.unpack('<ddd',payload)
+    msg = brtransport.Odometry()
+    msg.pose.pose.position.x = x
+    msg.pose.pose.position.y = y
+    msg.pose.pose.orientation.z = math.sin(yaw/2)
+    msg.pose.pose.orientation.w = math.cos(yaw/2)
+    return msg
+
+# a color just outside lo..hi, so it is never taken for the target
+def outsideColor(lo,hi):
+    color = list(lo)
+    for c in range(3):
+        if lo[c]>0:
+            color[c] = lo[c]-1
+            return tuple(color)
+        if hi[c]<255:
+            color[c] = hi[c]+1
+            return tuple(color)
+    return (0,0,0) # everything is the target
+
+# the light features as a one layer column image: each column shows its
+# count of target pixels, callback_Columns gets the same moments back
+def decodeColumns(payload):
+    h,w,*bounds = columnsHeader.unpack_from(payload)
+    counts = np.frombuffer(zlib.decompress(payload[columnsHeader.size:]),dtype='<f4')
+    lo,hi = tuple(bounds[:3]),tuple(bounds[3:])
+    colors = np.tile(np.array(lo,dtype=np.uint8),(w,1))
+    return brtransport.ColumnImage(h,w,[(colors,counts.astype(float))],outsideColor(lo,hi))
+
+def decodeJpeg(payload):
+    import cv2
+    frame = cv2.imdecode(np.frombuffer(payload,dtype=np.uint8),cv2.IMREAD_COLOR)
+    h,w = frame.shape[:2]
+    return brtransport.Image(h,w,'bgr8',3*w,frame.tobytes())
+
+def decodeCmd(payload):
+    return struct.unpack('<dd',payload)
+
+# the topic of each kind of record, by its name in the log's topics
+recordTopics = ((SCAN,'scan'),(ODOM,'odom'),(COLUMNS,'columns'),(JPEG,'image'))
+
+#
+# Replay: publishes the records of a log on a LocalTransport as its clock
+# passes their time, and records the commands the replayed vehicle sends,
+# for compare(). Its own transport starts the clock the start delay of a
+# new vehicle before the first record, so behave() starts at the first one.
+# The records go to the topics of the vehicle given to attach() (vehicle()
+# makes and attaches one), else to the recorded topics; either way every
+# kind of record must have a subscriber, or replaying raises ValueError.
+#
+class Replay():
+
+    def __init__(self,path,transport=None):
+        self.meta,records = readLog(path)
+        self.modelName = self.meta.get('model','')
+        self.simFlag = self.meta.get('simFlag',True)
+        self.topics = self.meta['topics']
+        self.records = sorted(records,key=lambda r:r[1]) # stable, keeps arrival order
+        self.times = np.array([t for kind,t,payload in self.records])
+        if transport is None:
+            # same clock as the log, so the behave() ticks keep their phase
+            transport = brtransport.LocalTransport(duration=self.times[-1] if len(self.times) else 0.0)
+            transport.time = (self.times[0] if len(self.times) else 0.0)-brtransport.startDelay
+        self.transport = transport
+        self.next = 0
+        self.loggedCommands = [(t,)+decodeCmd(p) for kind,t,p in self.records if kind==CMD]
+        self.commands = [] # (time, linear, angular) sent during replay
+        self.kinds = {kind for kind,t,payload in self.records}
+        self.publishers = None # kind -> publisher, see bind
+        self.cmdSub = None
+        self.decoders = {SCAN:decodeScan,ODOM:decodeOdom,COLUMNS:decodeColumns,JPEG:decodeJpeg}
+        transport.addStepper(self.step)
+
+    # a vehicle on the replay's transport, with the recorded vehicle's
+    # name and simFlag, attached to the replay; kwargs as for Braitenros
+    def vehicle(self,**kwargs):
+        import BBbraitenrosT3 as br
+        kwargs.setdefault('modelName',self.modelName)
+        kwargs.setdefault('simFlag',self.simFlag)
+        v = br.Braitenros(transport=self.transport,**kwargs)
+        self.attach(v)
+        return v
+
+    # replay to the topics of vehicle v, whatever namespace and camera
+    # topic the recorded vehicle had
+    def attach(self,v):
+        self.bind({'scan':v.laserTopic,'odom':v.poseTopic,'image':v.imageTopic,
+                   'columns':getattr(v,'columnTopic',None),'cmd':v.motionTopic})
+        return
+
+    # publish the records on topics (name -> topic, as in the log) and
+    # record the commands sent on topics['cmd']
+    def bind(self,topics):
+        subscribers = getattr(self.transport,'subscribers',None)
+        publishers = {}
+        for kind,name in recordTopics:
+            if kind not in self.kinds:
+                continue
+            topic = topics.get(name)
+            if topic is None or (subscribers is not None and not subscribers.get(topic)):
+                raise ValueError("brlog: the log has {} records but nothing subscribes to {}; "
+                                 "make the vehicle with replay.vehicle()".format(name,topic))
+            publishers[kind] = self.transport.publisher(topic,None)
+        if self.cmdSub is not None:
+            self.cmdSub.unregister()
+        self.cmdSub = self.transport.subscribe(topics['cmd'],brtransport.Twist,self.callback_Cmd)
+        self.publishers = publishers
+        return
+
+    # publish every record from before time t1 (a stepper publishing
+    # during the move from t0 to t1 sees now()==t0, so that is its stamp)
+    def step(self,t0,t1):
+        end = int(np.searchsorted(self.times,t1-timeSlack,'left'))
+        if self.publishers is None and self.next<end:
+            self.bind(self.topics) # not attached: the recorded topics
+        while self.next<end:
+            kind,t,payload = self.records[self.next]
+            self.next += 1
+            if kind in self.publishers:
+                self.publishers[kind].publish(self.decoders[kind](payload))
+        return
+
+    def callback_Cmd(self,msg):
+        self.commands.append((self.transport.now(),msg.linear.x,msg.angular.z))
+        return
+
+    # logged and replayed commands side by side: for every replayed command
+    # time, the command the robot was running then in the log and now
+    def compare(self):
+        replayed = np.array(self.commands).reshape(-1,3)
+        logged = np.array(self.loggedCommands).reshape(-1,3)
+        if len(logged)==0:
+            return replayed[:,0],np.full((len(replayed),2),np.nan),replayed[:,1:]
+        at = np.searchsorted(logged[:,0],replayed[:,0]+timeSlack,'right')-1
+        was = np.where(at[:,None]>=0,logged[np.maximum(at,0),1:],0.0)
+        return replayed[:,0],was,replayed[:,1:]
+
+#----------------------------------END-----------------------------
@@ -0,0 +1,224 @@
+#
+# BRAITENROS plotting
+# Trajectory and motor plots that stay quick for long and many-robot
+# runs: paths are decimated (distance, then largest-triangle-three-buckets)
+# before drawing, dense runs are drawn as an occupancy heatmap, and plots
+# can be written straight to a PNG/SVG file without opening a window
+#
+#   python3 brplot.py run1.brlog -o run1.png      # a sensor log (brlog)
+#   python3 brplot.py run.npz                     # saved telemetry
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import multiprocessing
+
+import numpy as np
+
+maxPoints = 4000 # points drawn per line
+heatPoints = 50000 # with more poses than this, also draw a heatmap
+heatBins = 256 # heatmap cells along the longer side
+
+#
+# decimation: both return the indices of the points kept, in order,
+# always including the first and the last
+#
+
+# one point per step (meters) travelled along the path, so a robot that
+# stands still for an hour adds one point, not thousands
+def decimateDistance(x,y,step):
+    n = len(x)
+    if n<3 or step<=0:
+        return np.arange(n)
+    travelled = np.concatenate(([0.0],np.cumsum(np.hypot(np.diff(x),np.diff(y)))))
+    keep = np.flatnonzero(np.diff(np.floor(travelled/step),prepend=-1.0))
+    if keep[-1]!=n-1:
+        keep = np.append(keep,n-1)
+    return keep
+
+# largest triangle three buckets: n points that keep the shape of the
+# line; from each bucket of points the one making the largest triangle
+# with the point kept before and the mean of the next bucket
+def lttb(x,y,n):
+    count = len(x)
+    if n>=count or n<3:
+        return np.arange(count)
+    edges = (np.arange(n-1)*((count-2)/(n-2))).astype(int)+1 # bucket starts
+    edges[-1] = count-1
+    keep = np.empty(n,dtype=np.int64)
+    keep[0],keep[-1] = 0,count-1
+    a = 0
+    for i in range(n-2):
+        start,end = edges[i],edges[i+1]
+        nextEnd = edges[i+2] if i+2<n-1 else count
+        mx,my = x[end:nextEnd].mean(),y[end:nextEnd].mean()
+        area = np.abs((x[a]-mx)*(y[start:end]-y[a])-(x[a]-x[start:end])*(my-y[a]))
+        a = start+int(np.argmax(area))
+        keep[i+1] = a
+    return keep
+
+# a path of at most points points: drop the unset (nan) poses, thin it
+# to one point per 1/points of its size, then lttb what is left
+def reducePath(x,y,points=maxPoints):
+    x,y = np.asarray(x,dtype=float),np.asarray(y,dtype=float)
+    ok = np.isfinite(x)&np.isfinite(y)
+    x,y = x[ok],y[ok]
+    if len(x)>points:
+        size = max(np.ptp(x),np.ptp(y))
+        keep = decimateDistance(x,y,size/points)
+        x,y = x[keep],y[keep]
+        keep = lttb(x,y,points)
+        x,y = x[keep],y[keep]
+    return x,y
+
+# a time series of at most points points
+def reduceSeries(t,v,points=maxPoints):
+    t,v = np.asarray(t,dtype=float),np.asarray(v,dtype=float)
+    keep = lttb(t,v,points)
+    return t[keep],v[keep]
+
+# poses per cell of a grid over all the runs: counts (x by y), extent
+def occupancy(xs,ys,bins=heatBins):
+    x,y = np.concatenate(xs),np.concatenate(ys)
+    ok = np.isfinite(x)&np.isfinite(y)
+    x,y = x[ok],y[ok]
+    if len(x)==0:
+        return None
+    x0,x1,y0,y1 = x.min(),x.max(),y.min(),y.max()
+    size = max(x1-x0,y1-y0,1e-6)
+    nx = max(1,int(round(bins*(x1-x0)/size)))
+    ny = max(1,int(round(bins*(y1-y0)/size)))
+    counts,xe,ye = np.histogram2d(x,y,bins=(nx,ny),range=((x0,x0+max(x1-x0,1e-6)),(y0,y0+max(y1-y0,1e-6))))
+    return counts,(xe[0],xe[-1],ye[0],ye[-1])
+
+#
+# Plots are made in two steps: prepare...() does the O(n) work on the full
+# data and returns a small dict; draw...(figure,prepared) draws it. That
+# way a plot window can be drawn by another process from little data.
+#
+
+# runs: list of (label,x,y); heatmap None decides by the number of poses
+def preparePositions(runs,points=maxPoints,heatmap=None,bins=heatBins,title="Robot position"):
+    total = sum(len(x) for label,x,y in runs)
+    if heatmap is None:
+        heatmap = total>heatPoints
+    lines = [(label,)+reducePath(x,y,points) for label,x,y in runs]
+    heat = occupancy([np.asarray(x,dtype=float) for l,x,y in runs],
+                     [np.asarray(y,dtype=float) for l,x,y in runs],bins) if heatmap and total else None
+    return {'kind':'positions','title':title,'lines':lines,'heat':heat}
+
+# runs: list of (label,t,vleft,vright)
+def prepareMotors(runs,points=maxPoints,title="Motor speeds"):
+    lines = []
+    for label,t,vleft,vright in runs:
+        prefix = label+" " if label else ""
+        lines.append((prefix+"Left",)+reduceSeries(t,vleft,points))
+        lines.append((prefix+"Right",)+reduceSeries(t,vright,points))
+    return {'kind':'motors','title':title,'lines':lines}
+
+def drawPositions(figure,prepared):
+    axes = figure.add_subplot(1,1,1)
+    if prepared['heat'] is not None:
+        counts,extent = prepared['heat']
+        image = axes.imshow(np.log1p(counts.T),origin='lower',extent=extent,
+                            cmap='magma',interpolation='nearest',aspect='equal')
+        figure.colorbar(image,ax=axes,label="log(1+poses)")
+    heat = prepared['heat'] is not None # lines thin, so the heatmap shows through
+    for label,x,y in prepared['lines']:
+        axes.plot(x,y,linewidth=0.4 if heat else 0.8,alpha=0.5 if heat else 1.0,
+                  marker='.' if len(x)<500 else None,markersize=3,label=label or None)
+    if any(label for label,x,y in prepared['lines']):
+        axes.legend(loc="upper right")
+    axes.set_title(prepared['title'])
+    axes.set_xlabel("X")
+    axes.set_ylabel("Y")
+    axes.set_aspect('equal','datalim')
+    return figure
+
+def drawMotors(figure,prepared):
+    axes = figure.add_subplot(1,1,1)
+    for label,t,v in prepared['lines']:
+        axes.plot(t,v,linewidth=0.8,label=label)
+    axes.legend(loc="upper right")
+    axes.set_title(prepared['title'])
+    axes.set_xlabel("Time")
+    axes.set_ylabel("Speed")
+    return figure
+
+drawers = {'positions':drawPositions,'motors':drawMotors}
+
+# write a prepared plot to path, the format from its extension (png,
+# svg, pdf ..); no window and no pyplot, so it also works without a display
+def save(prepared,path,size=(8,6),dpi=120):
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=size)
+    drawers[prepared['kind']](figure,prepared)
+    figure.savefig(path,dpi=dpi,bbox_inches='tight')
+    return path
+
+def showWindow(prepared,size):
+    from matplotlib import pyplot as plt
+    drawers[prepared['kind']](plt.figure(figsize=size),prepared)
+    plt.show()
+    return
+
+# show a prepared plot in a window of another process ('spawn', as the
+# viewer): returns at once, the window stays until it is closed
+def show(prepared,size=(8,6),method='spawn'):
+    process = multiprocessing.get_context(method).Process(target=showWindow,args=(prepared,size),name="plot")
+    process.start()
+    return process
+
+# save to path if given, else show
+def output(prepared,path=None):
+    if path is not None:
+        save(prepared,path)
+        print("Plot written to "+path)
+        return path
+    return show(prepared)
+
+#
+# reading runs back
+#
+
+# x,y of every odometry record of a sensor log (see brlog)
+def logPath(path):
+    import brlog
+    meta,records = brlog.readLog(path)
+    odom = b"".join(payload for kind,t,payload in records if kind==brlog.ODOM)
+    xyyaw = np.frombuffer(odom,dtype='<f8').reshape(-1,3)
+    return xyyaw[:,0],xyyaw[:,1]
+
+# x,y of saved telemetry (Telemetry.save, an .npz or a directory of .npy)
+def telemetryPath(path):
+    import os
+    if os.path.isdir(path):
+        return np.load(os.path.join(path,"x.npy")),np.load(os.path.join(path,"y.npy"))
+    with np.load(path) as cols:
+        return cols['x'],cols['y']
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Braitenros trajectory plots")
+    parser.add_argument('runs',nargs='+',help=".brlog sensor logs or saved telemetry (.npz or directory)")
+    parser.add_argument('-o','--output',help="write to this .png/.svg/.pdf instead of opening a window")
+    parser.add_argument('--points',type=int,default=maxPoints,help="points drawn per run")
+    parser.add_argument('--heatmap',choices=('auto','on','off'),default='auto')
+    parser.add_argument('--bins',type=int,default=heatBins)
+    args = parser.parse_args()
+    runs = []
+    for path in args.runs:
+        x,y = logPath(path) if path.endswith(".brlog") else telemetryPath(path)
+        runs.append((path,x,y))
+    heatmap = {'auto':None,'on':True,'off':False}[args.heatmap]
+    prepared = preparePositions(runs,args.points,heatmap,args.bins)
+    if args.output:
+        output(prepared,args.output)
+    else:
+        showWindow(prepared,(8,6))
+
+#----------------------------------END-----------------------------
@@ -0,0 +1,295 @@
+#
+# BRAITENROS headless simulator
+# A 2D differential drive simulation of Turtlebot3 robots that runs on the
+# in-process transport, faster than real time, instead of Gazebo
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import math
+import random
+
+import numpy as np
+
+import brtransport
+import brworld
+
+#
+# The simulator subscribes to <model>/cmd_vel for every robot, integrates
+# the Twist commands on a fixed physics step driven by the transport clock
+# and publishes <model>/scan and <model>/odom just as Gazebo would.
+#
+# Usage:
+#   sim = brsim.Simulator(seed=1,duration=600)
+#   sim.addBox(2.0,0.0,0.2,4.0)
+#   sim.addRobot("",0.0,0.0,0.0)
+#   v1 = br.Braitenros(transport=sim.transport)
+#
+# or, with the arena and spawn points of a Gazebo launch file:
+#   sim = brsim.Simulator(seed=1)
+#   sim.loadLaunch("myworld5.launch")
+#
+# Light sources (e.g. a sheet of white paper) are only seen by the camera.
+# The camera is rendered one column per image pixel: camera='columns'
+# publishes just the colored columns on <model>/camera/columns, which
+# callback_Columns turns into the light sensors without any image;
+# camera='image' also paints a full BGR frame for callback_Image.
+#
+# def castRays(ox,oy,angles,walls,circles,maxRange) -- vectorized ray casting
+# ----------------------------------------------
+
+robotRadius = 0.105 # meters, Turtlebot3 burger footprint
+robotScanRadius = 0.07 # meters, what the laser plane cuts of another T3
+laserRays = 360     # one per degree, counter clockwise from straight ahead
+laserRange = 3.5    # meters, LDS-01 maximum range
+cameraRange = 10.0  # meters, the camera does not see walls further away
+
+# camera, same field of view as callback_Image
+cameraFOV = math.radians(62.5)
+cameraBackground = (60,60,60) # BGR of floor and sky
+
+# closest wall segment along each ray
+# angles: absolute ray angles (R,); walls: segments x0,y0,x1,y1 (S,4)
+# returns distances (R,), inf for a miss, and the index of the wall hit
+def wallHits(ox,oy,angles,walls):
+    if len(walls)==0:
+        return np.full(len(angles),np.inf),np.zeros(len(angles),dtype=int)
+    dx = np.cos(angles)[:,None]
+    dy = np.sin(angles)[:,None]
+    px,py = walls[:,0]-ox, walls[:,1]-oy
+    ex,ey = walls[:,2]-walls[:,0], walls[:,3]-walls[:,1]
+    denom = dx*ey-dy*ex
+    with np.errstate(divide='ignore',invalid='ignore'):
+        t = (px*ey-py*ex)/denom
+        u = (px*dy-py*dx)/denom
+    t = np.where((denom!=0)&(t>0)&(u>=0)&(u<=1),t,np.inf)
+    index = t.argmin(axis=1)
+    return t[np.arange(len(angles)),index],index
+
+# closest circle along each ray; circles are centers and radii x,y,r (C,3)
+def circleHits(ox,oy,angles,circles):
+    if len(circles)==0:
+        return np.full(len(angles),np.inf),np.zeros(len(angles),dtype=int)
+    dx = np.cos(angles)[:,None]
+    dy = np.sin(angles)[:,None]
+    fx,fy = circles[:,0]-ox, circles[:,1]-oy
+    b = dx*fx+dy*fy
+    disc = b*b-(fx*fx+fy*fy-circles[:,2]**2)
+    with np.errstate(invalid='ignore'):
+        t = b-np.sqrt(disc)
+    t = np.where((disc>=0)&(t>0),t,np.inf)
+    index = t.argmin(axis=1)
+    return t[np.arange(len(angles)),index],index
+
+# distance along each ray to the closest wall segment or circle
+def castRays(ox,oy,angles,walls,circles=None,maxRange=laserRange):
+    best = wallHits(ox,oy,angles,walls)[0]
+    if circles is not None:
+        best = np.minimum(best,circleHits(ox,oy,angles,circles)[0])
+    best[best>maxRange] = np.inf
+    return best
+
+# distance from points (P,2) to the closest wall segment (S,4)
+def wallDistance(points,walls):
+    if len(walls)==0:
+        return np.full(len(points),np.inf)
+    ax,ay = walls[:,0],walls[:,1]
+    ex,ey = walls[:,2]-ax, walls[:,3]-ay
+    elen = np.maximum(ex*ex+ey*ey,1e-12)
+    wx = points[:,0:1]-ax
+    wy = points[:,1:2]-ay
+    s = np.clip((wx*ex+wy*ey)/elen,0.0,1.0)
+    return np.hypot(wx-s*ex,wy-s*ey).min(axis=1)
+
+# one simulated robot, kept as an index into the simulator arrays
+class SimRobot():
+    def __init__(self,sim,index,modelName):
+        self.sim = sim
+        self.index = index
+        self.modelName = modelName
+        self.scanPub = sim.transport.publisher(modelName+'/scan',brtransport.LaserScan)
+        self.odomPub = sim.transport.publisher(modelName+'/odom',brtransport.Odometry)
+        self.columnPub = sim.transport.publisher(modelName+'/camera/columns',brtransport.ColumnImage)
+        self.imagePub = sim.transport.publisher(modelName+'/camera/rgb/image_raw',brtransport.Image)
+        sim.transport.subscribe(modelName+'/cmd_vel',brtransport.Twist,self.callback_Twist)
+
+    def callback_Twist(self,msg):
+        self.sim.cmd[self.index,0] = msg.linear.x
+        self.sim.cmd[self.index,1] = msg.angular.z
+        return
+
+    @property
+    def pose(self):
+        return tuple(self.sim.state[self.index])
+
+class Simulator():
+
+    def __init__(self,transport=None,seed=0,duration=None,physicsRate=50.0,scanRate=5.0,odomRate=30.0,laserNoise=0.0,
+                 camera='columns',cameraRate=10.0,cameraWidth=320,cameraHeight=240,scene=None):
+        if transport is None:
+            transport = brtransport.LocalTransport(duration)
+        self.transport = transport
+        # everything random is seeded so that runs can be repeated exactly
+        random.seed(seed) # v.random() in behaviors
+        self.rng = np.random.default_rng(seed)
+        self.laserNoise = laserNoise # std dev in meters
+        self.dt = 1.0/physicsRate
+        self.scanEvery = max(1,int(round(physicsRate/scanRate)))
+        self.odomEvery = max(1,int(round(physicsRate/odomRate)))
+        self.tick = 0 # physics steps so far; time is tick*dt
+        self.scene = scene if scene is not None else brworld.Scene()
+        # camera: None, 'columns' or 'image'
+        self.camera = camera
+        self.cameraEvery = max(1,int(round(physicsRate/cameraRate)))
+        self.cameraWidth,self.cameraHeight = cameraWidth,cameraHeight
+        self.focal = (cameraWidth/2.0)/math.tan(cameraFOV/2) # pixels
+        u = np.arange(cameraWidth)+0.5
+        self.columnOffsets = np.arctan((cameraWidth/2.0-u)/self.focal) # left is +ve
+        self.columnCos = np.cos(self.columnOffsets)
+        self.robots = []
+        self.state = np.zeros((0,3)) # x,y,theta per robot
+        self.cmd = np.zeros((0,2))   # linear, angular velocity per robot
+        self.rayOffsets = np.arange(laserRays)*(2*math.pi/laserRays)
+        transport.addStepper(self.step)
+
+    # add a wall from x0,y0 to x1,y1; color is BGR as seen by the camera
+    def addWall(self,x0,y0,x1,y1,color=(128,128,128),height=1.0):
+        self.scene.addWall(x0,y0,x1,y1,color,height)
+        return
+
+    # add a box centered on cx,cy of size sx by sy, rotated by yaw
+    def addBox(self,cx,cy,sx,sy,yaw=0.0,color=(128,128,128),height=1.0):
+        self.scene.addBox(cx,cy,sx,sy,yaw,color,height)
+        return
+
+    # add a light source (only the camera sees it), default white paper
+    def addLight(self,x,y,color=(255,255,255),radius=0.15,height=0.3):
+        self.scene.addLight(x,y,color,radius,height)
+        return
+
+    # use the world and robot spawn points of a Gazebo launch file
+    def loadLaunch(self,path):
+        world = brworld.loadLaunch(path)
+        self.scene = world.scene
+        for modelName,x,y,yaw in world.spawns:
+            self.addRobot(modelName,x,y,yaw)
+        return world
+
+    # add a robot; modelName is the ROS namespace, "" for the first robot
+    def addRobot(self,modelName="",x=0.0,y=0.0,theta=0.0):
+        self.state = np.vstack([self.state,[x,y,theta]])
+        self.cmd = np.vstack([self.cmd,[0.0,0.0]])
+        robot = SimRobot(self,len(self.robots),modelName)
+        self.robots.append(robot)
+        return robot
+
+    def now(self):
+        return self.tick*self.dt
+
+    # transport stepper: run all physics steps that fall in (t0,t1]
+    def step(self,t0,t1):
+        while (self.tick+1)*self.dt<=t1+1e-9:
+            self.tick += 1
+            self.integrate()
+            if self.tick%self.odomEvery==0:
+                self.publishOdom()
+            if self.tick%self.scanEvery==0:
+                self.publishScans()
+            if self.camera and self.tick%self.cameraEvery==0:
+                self.publishCamera()
+        return
+
+    # move every robot one physics step; a robot that would hit a wall
+    # or another robot only turns
+    def integrate(self):
+        if len(self.robots)==0:
+            return
+        v,w = self.cmd[:,0],self.cmd[:,1]
+        theta = self.state[:,2]
+        mid = theta+0.5*w*self.dt
+        moved = self.state[:,0:2]+self.dt*np.column_stack([v*np.cos(mid),v*np.sin(mid)])
+        near = np.unique(np.concatenate([self.scene.nearbyWalls(x,y,2*robotRadius) for x,y in moved]))
+        blocked = wallDistance(moved,self.scene.walls[near])<robotRadius
+        if len(self.robots)>1:
+            d = np.hypot(moved[:,0:1]-moved[:,0],moved[:,1:2]-moved[:,1])
+            np.fill_diagonal(d,np.inf)
+            blocked |= d.min(axis=1)<2*robotRadius
+        self.state[:,0:2] = np.where(blocked[:,None],self.state[:,0:2],moved)
+        self.state[:,2] = np.arctan2(np.sin(theta+w*self.dt),np.cos(theta+w*self.dt))
+        return
+
+    def publishOdom(self):
+        for robot in self.robots:
+            x,y,theta = self.state[robot.index]
+            msg = brtransport.Odometry()
+            msg.pose.pose.position.x = float(x)
+            msg.pose.pose.position.y = float(y)
+            msg.pose.pose.orientation.z = math.sin(theta/2)
+            msg.pose.pose.orientation.w = math.cos(theta/2)
+            robot.odomPub.publish(msg)
+        return
+
+    # the laser of each robot sees the walls and the other robots
+    def publishScans(self):
+        circles = np.column_stack([self.state[:,0:2],np.full(len(self.robots),robotScanRadius)])
+        for robot in self.robots:
+            x,y,theta = self.state[robot.index]
+            others = np.delete(circles,robot.index,axis=0)
+            ranges = self.scan(x,y,theta,others)
+            msg = brtransport.LaserScan(ranges)
+            msg.angle_increment = 2*math.pi/laserRays
+            msg.angle_max = 2*math.pi-msg.angle_increment
+            msg.range_min,msg.range_max = 0.12,laserRange
+            robot.scanPub.publish(msg)
+        return
+
+    def publishCamera(self):
+        for robot in self.robots:
+            columns = self.renderColumns(*self.state[robot.index])
+            if self.camera=='image':
+                robot.imagePub.publish(self.renderImage(columns))
+            else:
+                robot.columnPub.publish(columns)
+        return
+
+    # what each camera column sees: the closest light in front of the
+    # closest wall, each as tall as its height allows at that distance
+    def renderColumns(self,x,y,theta):
+        scene = self.scene
+        angles = theta+self.columnOffsets
+        near = scene.nearbyWalls(x,y,cameraRange)
+        wd,wi = wallHits(x,y,angles,scene.walls[near])
+        wi = near[wi] if len(near)>0 else wi
+        ld,li = circleHits(x,y,angles,scene.lights)
+        layers = []
+        with np.errstate(divide='ignore'):
+            if len(scene.lights)>0:
+                ext = np.where(ld<wd,self.focal*scene.lightHeights[li]/(ld*self.columnCos),0.0)
+                layers.append((scene.lightColors[li],np.minimum(ext,self.cameraHeight)))
+            if len(near)>0:
+                ext = np.where(np.isfinite(wd),self.focal*scene.wallHeights[wi]/(wd*self.columnCos),0.0)
+                layers.append((scene.wallColors[wi],np.minimum(ext,self.cameraHeight)))
+        return brtransport.ColumnImage(self.cameraHeight,self.cameraWidth,layers,cameraBackground)
+
+    # paint the columns into a full bgr8 image message
+    def renderImage(self,columns):
+        h,w = columns.height,columns.width
+        fromHorizon = np.abs(np.arange(h)+0.5-h/2.0)[:,None]
+        frame = np.empty((h,w,3),dtype=np.uint8)
+        frame[:] = columns.background
+        for colors,extents in reversed(columns.layers): # back to front
+            frame = np.where((fromHorizon<extents/2.0)[:,:,None],colors[None,:,:],frame)
+        return brtransport.Image(h,w,'bgr8',3*w,frame.tobytes())
+
+    def scan(self,x,y,theta,circles):
+        walls = self.scene.walls[self.scene.nearbyWalls(x,y,laserRange)]
+        ranges = castRays(x,y,theta+self.rayOffsets,walls,circles)
+        if self.laserNoise>0:
+            ranges = ranges+self.rng.normal(0.0,self.laserNoise,laserRays)
+        return ranges
+
+#----------------------------------END-----------------------------
@@ -0,0 +1,178 @@
+#
+# BRAITENROS telemetry
+# Bounded memory record of a run: one row per behavior tick, stored as
+# preallocated NumPy column chunks instead of ever growing python lists
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+#
+# Telemetry(columns, chunkSize, maxSamples, policy, every, spillDir)
+#
+# columns: list of (name,dtype), every dtype 8 bytes wide
+# maxSamples: how many rows are kept at most (None: no limit)
+# policy, what happens when maxSamples is reached:
+#   'decimate' keeps the whole run: every other stored row is dropped
+#              and from then on only every 2nd (4th, 8th..) tick is kept
+#   'drop'     keeps the most recent maxSamples rows at full rate
+# every: keep only every n-th record to begin with
+# spillDir: if given, chunks are memory mapped files in this directory
+#           (True for a temporary directory, removed with the Telemetry),
+#           so a long run lives on disk
+#
+# Each chunk is one block of chunkSize rows per column; with spillDir the
+# columns of a chunk are consecutive regions of one file.
+# ----------------------------------------------
+
+class Telemetry():
+
+    def __init__(self,columns,chunkSize=1<<14,maxSamples=None,policy='decimate',every=1,spillDir=None):
+        if policy not in ('decimate','drop'):
+            raise ValueError("policy must be 'decimate' or 'drop'")
+        self.columns = [(name,np.dtype(dtype)) for name,dtype in columns]
+        for name,dtype in self.columns:
+            if dtype.itemsize!=8:
+                raise ValueError("column "+name+" must be 8 bytes wide")
+        self.names = [name for name,dtype in self.columns]
+        self.chunkSize = chunkSize
+        if maxSamples is not None:
+            maxSamples = max(maxSamples,2*chunkSize) # at least 2 chunks
+        self.maxSamples = maxSamples
+        self.policy = policy
+        self.every = every
+        if spillDir is True:
+            spillDir = tempfile.mkdtemp(prefix="braitenros")
+            # the chunk files go with their chunks, the directory when
+            # this is garbage collected or python exits
+            weakref.finalize(self,shutil.rmtree,spillDir,True)
+        self.spillDir = spillDir
+        self.chunks = [] # each a dict name -> array of chunkSize
+        self.files = [] # spill files of each chunk
+        self.fill = 0 # rows used in the last chunk
+        self.offered = 0 # records offered to append
+        self.dropped = 0 # rows removed by the 'drop' policy
+        self.fileCount = 0
+
+    def newChunk(self):
+        if self.spillDir is None:
+            chunk = {name:np.empty(self.chunkSize,dtype) for name,dtype in self.columns}
+            path = None
+        else:
+            path = os.path.join(self.spillDir,"chunk{:06d}.bin".format(self.fileCount))
+            self.fileCount += 1
+            size = 8*self.chunkSize
+            f = np.memmap(path,dtype=np.uint8,mode='w+',shape=(size*len(self.columns),))
+            chunk = {name:f[i*size:(i+1)*size].view(dtype) for i,(name,dtype) in enumerate(self.columns)}
+        self.chunks.append(chunk)
+        self.files.append([path] if path is not None else [])
+        self.fill = 0
+        return
+
+    # a new column, zero in the rows already recorded; spilled chunks
+    # get a file of their own for it
+    def addColumn(self,name,dtype):
+        dtype = np.dtype(dtype)
+        if dtype.itemsize!=8:
+            raise ValueError("column "+name+" must be 8 bytes wide")
+        if name in self.names:
+            raise ValueError("column "+name+" already exists")
+        for chunk,files in zip(self.chunks,self.files):
+            if self.spillDir is None:
+                chunk[name] = np.zeros(self.chunkSize,dtype)
+            else:
+                path = os.path.join(self.spillDir,"chunk{:06d}.bin".format(self.fileCount))
+                self.fileCount += 1
+                chunk[name] = np.memmap(path,dtype=dtype,mode='w+',shape=(self.chunkSize,))
+                files.append(path)
+        self.columns.append((name,dtype))
+        self.names.append(name)
+        return
+
+    # add one row, values in column order
+    def append(self,*values):
+        self.offered += 1
+        if (self.offered-1)%self.every:
+            return
+        if not self.chunks or self.fill==self.chunkSize:
+            if self.maxSamples is not None and len(self)>=self.maxSamples:
+                self.retain()
+            if not self.chunks or self.fill==self.chunkSize:
+                self.newChunk()
+        chunk,i = self.chunks[-1],self.fill
+        for name,value in zip(self.names,values):
+            chunk[name][i] = value
+        self.fill += 1
+        return
+
+    def __len__(self):
+        if not self.chunks:
+            return 0
+        return (len(self.chunks)-1)*self.chunkSize+self.fill
+
+    # make room once maxSamples is reached (all chunks are full here)
+    def retain(self):
+        if self.policy=='drop':
+            self.releaseChunk(0)
+            self.dropped += self.chunkSize
+            return
+        # halve every column and pack the rows into the first half of the chunks
+        n = len(self.chunks)
+        for name in self.names:
+            kept = np.concatenate([c[name] for c in self.chunks])[::2]
+            for k in range(n):
+                part = kept[k*self.chunkSize:(k+1)*self.chunkSize]
+                self.chunks[k][name][:len(part)] = part
+        for k in range(n-1,(n+1)//2-1,-1):
+            self.releaseChunk(k)
+        self.fill = len(kept)-(len(self.chunks)-1)*self.chunkSize
+        self.every *= 2
+        self.offered = 1 # this record starts the new stride
+        return
+
+    def releaseChunk(self,k):
+        self.chunks.pop(k)
+        for path in self.files.pop(k):
+            os.remove(path)
+        return
+
+    # one column as a single array (a copy)
+    def column(self,name):
+        n = len(self)
+        out = np.empty(n,dict(self.columns)[name])
+        for k,chunk in enumerate(self.chunks):
+            part = chunk[name][:min(self.chunkSize,n-k*self.chunkSize)]
+            out[k*self.chunkSize:k*self.chunkSize+len(part)] = part
+        return out
+
+    def arrays(self):
+        return {name:self.column(name) for name in self.names}
+
+    # write all columns, as one .npz file (or one .npy per column if path
+    # is a directory)
+    def save(self,path):
+        cols = self.arrays()
+        if os.path.isdir(path):
+            for name,col in cols.items():
+                np.save(os.path.join(path,name+".npy"),col)
+        else:
+            np.savez(path,**cols)
+        return
+
+    def clear(self):
+        while self.chunks:
+            self.releaseChunk(0)
+        self.fill = 0
+        return
+
+#----------------------------------END-----------------------------
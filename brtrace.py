@@ -0,0 +1,222 @@
+#
+# BRAITENROS behavior tracing and profiling
+# Records what every behavior did on every tick into a preallocated ring
+# buffer; printing or saving happens later, away from the control loop.
+# Also keeps latency histograms of callbacks and behaviors.
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import json
+import math
+import sys
+import threading
+import time
+
+import numpy as np
+
+#
+# BehaviorTrace: columns tick, behavior slot, released, vleft and vright
+# change. The behave() loop is the only writer; head counts every record
+# ever written, so a reader that falls more than capacity records behind
+# knows how many it lost.
+#
+# TracePrinter: a background thread that prints new records as
+#   T2 [ backoff- stop- seefront+ ]
+# one line per tick (or every n-th tick).
+# ----------------------------------------------
+
+class BehaviorTrace():
+
+    def __init__(self,names,capacity=1<<16):
+        self.names = names # slot -> behavior name, grows with the plan
+        self.capacity = capacity
+        self.tick = np.zeros(capacity,dtype=np.int64)
+        self.slot = np.zeros(capacity,dtype=np.int16)
+        self.released = np.zeros(capacity,dtype=bool)
+        self.dleft = np.zeros(capacity,dtype=np.float32)
+        self.dright = np.zeros(capacity,dtype=np.float32)
+        self.head = 0
+        self.enabled = True
+
+    def record(self,tick,slot,released,dleft,dright):
+        i = self.head%self.capacity
+        self.tick[i] = tick
+        self.slot[i] = slot
+        self.released[i] = released
+        self.dleft[i] = dleft
+        self.dright[i] = dright
+        self.head += 1
+        return
+
+    # records from number start up to the current head, as a dict of
+    # column arrays; also returns how many were overwritten before reading
+    def read(self,start):
+        head = self.head
+        lost = max(0,head-self.capacity-start)
+        start += lost
+        idx = np.arange(start,head)%self.capacity
+        cols = {'tick':self.tick[idx],'slot':self.slot[idx],'released':self.released[idx],
+                'dleft':self.dleft[idx],'dright':self.dright[idx]}
+        # the writer may have lapped us while we copied
+        overrun = max(0,self.head-self.capacity-start)
+        if overrun:
+            for k in cols:
+                cols[k] = cols[k][overrun:]
+            lost += overrun
+        return cols,head,lost
+
+    # save what is still in the buffer as a .npz file
+    def save(self,path):
+        cols,head,lost = self.read(max(0,self.head-self.capacity))
+        np.savez(path,names=np.array(self.names),**cols)
+        return
+
+# one line per tick: name+ if released, name- if not
+def formatTicks(cols,names,prefix="",every=1):
+    lines = []
+    ticks = cols['tick']
+    if len(ticks)==0:
+        return lines
+    breaks = np.flatnonzero(np.diff(ticks))+1
+    for start,end in zip(np.concatenate(([0],breaks)),np.concatenate((breaks,[len(ticks)]))):
+        if ticks[start]%every:
+            continue
+        items = [names[s]+("+" if r else "-") for s,r in zip(cols['slot'][start:end],cols['released'][start:end])]
+        lines.append(prefix+" [ "+" ".join(items)+" ]")
+    return lines
+
+class TracePrinter():
+
+    def __init__(self,trace,prefix="",every=1,interval=0.2,out=None):
+        self.trace = trace
+        self.prefix = prefix
+        self.every = every # print every n-th tick
+        self.interval = interval # seconds between checks
+        self.out = out if out is not None else sys.stdout
+        self.cursor = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.cursor = self.trace.head
+        self.running = True
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        return
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.drain()
+        return
+
+    # print everything recorded since the last call; the last tick may
+    # still be being written, so it waits for the next call unless final
+    def drain(self,final=False):
+        cols,head,lost = self.trace.read(self.cursor)
+        ticks = cols['tick']
+        if not final and len(ticks):
+            keep = int(np.searchsorted(ticks,ticks[-1]))
+            head -= len(ticks)-keep
+            cols = {k:c[:keep] for k,c in cols.items()}
+        self.cursor = head
+        text = formatTicks(cols,self.trace.names,self.prefix,self.every)
+        if lost:
+            text.insert(0,self.prefix+" ... {} trace records dropped".format(lost))
+        if text:
+            self.out.write("\n".join(text)+"\n")
+        return
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.drain(final=True)
+        return
+
+#
+# Profiler: one LatencyHistogram per name (a callback, a behavior, ..).
+# Durations go into fixed log spaced bins, 10 per decade from 1us to 100s,
+# so recording is one log10 and one increment and memory never grows.
+# Percentiles are read back from the bins (to within one bin, ~26%).
+# The behave() loop and the sensor and image threads all add to the same
+# Profiler, so it adds, and reads back, under a lock.
+# ----------------------------------------------
+
+binsPerDecade = 10
+smallest = 1e-6 # seconds, lower edge of bin 1 (bin 0 is everything below)
+binCount = 8*binsPerDecade+2 # up to 100 s, the last bin is everything above
+
+class LatencyHistogram():
+    __slots__ = ('counts','count','total','largest')
+
+    def __init__(self):
+        self.counts = [0]*binCount # a list, faster than numpy per item
+        self.count = 0
+        self.total = 0.0
+        self.largest = 0.0
+
+    def add(self,seconds):
+        if seconds<smallest:
+            i = 0
+        else:
+            i = min(binCount-1,1+int(math.log10(seconds/smallest)*binsPerDecade))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds>self.largest:
+            self.largest = seconds
+        return
+
+    # upper edge of the bin holding the q quantile (0..1)
+    def quantile(self,q):
+        if self.count==0:
+            return 0.0
+        cum = np.cumsum(self.counts)
+        i = int(np.searchsorted(cum,q*self.count))
+        return min(self.largest,smallest*10**(i/binsPerDecade))
+
+    def summary(self):
+        return {'count':self.count,'mean':self.total/self.count if self.count else 0.0,
+                'p50':self.quantile(0.5),'p90':self.quantile(0.9),'p99':self.quantile(0.99),
+                'max':self.largest}
+
+class Profiler():
+
+    def __init__(self):
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add(self,name,seconds):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = LatencyHistogram()
+            h.add(seconds)
+        return
+
+    # name -> count, mean, p50, p90, p99 and max in seconds
+    def stats(self):
+        with self.lock:
+            return {name:h.summary() for name,h in sorted(self.histograms.items())}
+
+    # stats and the raw bins as JSON
+    def save(self,path,extra=None):
+        out = {'started':self.started,'saved':time.time(),
+               'binsPerDecade':binsPerDecade,'smallest':smallest,
+               'stats':self.stats()}
+        with self.lock:
+            out['bins'] = {name:list(h.counts) for name,h in self.histograms.items()}
+        if extra:
+            out.update(extra)
+        with open(path,'w') as f:
+            json.dump(out,f,indent=1)
+        return
+
+#----------------------------------END-----------------------------
@@ -0,0 +1,391 @@
+#
+# BRAITENROS transport backends
+# Lets a Braitenros vehicle run either on ROS1 (rospy) or on an
+# in-process message bus with a simulated clock (no ROS master needed)
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import threading
+
+#
+# Both transports offer the same small interface, used by Braitenros:
+#
+# def initNode(self,name): # start the node (once per process)
+# def subscribe(self,topic,msgType,callback): # call callback for each msg
+# def publisher(self,topic,msgType): # returns an object with publish(msg)
+# def rate(self,hz): # returns an object with sleep()
+# def waitEvent(self,event,timeout): # wait for a threading.Event, True if set
+# def sleep(self,secs):
+# def now(self): # seconds, wall clock for ROS, simulated clock otherwise
+# def isShutdown(self):
+# def onShutdown(self,callback):
+# def log(self,text):
+#
+# InterruptException is raised to stop a behave() loop
+# ----------------------------------------------
+
+# raised to stop behavior on the in-process transport
+class BehaviorInterrupt(Exception):
+    pass
+
+# seconds a new vehicle waits before its behavior can start (for the ROS
+# connections to come up), also on the simulated clock
+startDelay = 3.0
+
+#
+# Light weight stand-ins for the ROS messages used by Braitenros.
+# They only carry the fields that the Braitenros callbacks read.
+#
+
+class Vector3():
+    __slots__ = ('x','y','z')
+    def __init__(self,x=0.0,y=0.0,z=0.0):
+        self.x,self.y,self.z=x,y,z
+
+class Quaternion():
+    __slots__ = ('x','y','z','w')
+    def __init__(self,x=0.0,y=0.0,z=0.0,w=1.0):
+        self.x,self.y,self.z,self.w=x,y,z,w
+
+class Twist():
+    __slots__ = ('linear','angular')
+    def __init__(self):
+        self.linear=Vector3()
+        self.angular=Vector3()
+
+class Pose():
+    __slots__ = ('position','orientation')
+    def __init__(self):
+        self.position=Vector3()
+        self.orientation=Quaternion()
+
+class PoseWithCovariance():
+    __slots__ = ('pose',)
+    def __init__(self):
+        self.pose=Pose()
+
+class Odometry():
+    __slots__ = ('pose',)
+    def __init__(self):
+        self.pose=PoseWithCovariance()
+
+class LaserScan():
+    __slots__ = ('angle_min','angle_max','angle_increment','range_min','range_max','ranges')
+    def __init__(self,ranges=()):
+        self.angle_min=0.0
+        self.angle_max=0.0
+        self.angle_increment=0.0
+        self.range_min=0.0
+        self.range_max=0.0
+        self.ranges=ranges
+
+class Image():
+    __slots__ = ('height','width','encoding','step','data')
+    def __init__(self,height=0,width=0,encoding='bgr8',step=0,data=b''):
+        self.height,self.width=height,width
+        self.encoding=encoding
+        self.step=step
+        self.data=data
+
+# A camera image reduced to one pixel row: every column holds a stack of
+# layers (front to back), each a BGR color and a height in pixels centered
+# on the image horizon. Rows not covered by any layer show the background.
+# Only published by the simulator, there is no ROS equivalent.
+class ColumnImage():
+    __slots__ = ('height','width','layers','background')
+    def __init__(self,height=0,width=0,layers=(),background=(0,0,0)):
+        self.height,self.width=height,width
+        self.layers=layers # list of (colors (W,3), extents (W,))
+        self.background=background
+
+#
+# ROS1 backend, a thin wrapper around rospy
+#
+class RosTransport():
+    isLocal = False
+    anonymous = False # True in fleet worker processes, one node each
+
+    def __init__(self):
+        import rospy # only needed for this backend
+        self.rospy = rospy
+        self.InterruptException = rospy.ROSInterruptException
+        self.nodeStarted = False
+        self.fleetPoses = None # pose table of the vehicles on this transport, see BBbraitenrosT3.poseTable
+
+    def initNode(self,name):
+        if not self.nodeStarted: # everything is just 1 node
+            self.rospy.init_node(name, anonymous=self.anonymous)
+            self.nodeStarted = True
+        return
+
+    def subscribe(self,topic,msgType,callback):
+        return self.rospy.Subscriber(topic,msgType,callback)
+
+    def publisher(self,topic,msgType):
+        return self.rospy.Publisher(topic,msgType,queue_size=0)
+
+    def rate(self,hz):
+        return self.rospy.Rate(hz)
+
+    def waitEvent(self,event,timeout):
+        return event.wait(timeout)
+
+    def sleep(self,secs):
+        self.rospy.sleep(secs)
+        return
+
+    def now(self):
+        return self.rospy.get_time()
+
+    def isShutdown(self):
+        return self.rospy.is_shutdown()
+
+    def onShutdown(self,callback):
+        self.rospy.on_shutdown(callback)
+        return
+
+    def log(self,text):
+        self.rospy.loginfo(text)
+        return
+
+#
+# In-process backend: topics are delivered by direct function call and
+# time is a simulated clock that only moves when someone sleeps, so a
+# behave() loop runs as fast as the CPU allows.
+#
+# Steppers (e.g. a simulator) are called as stepper(t0,t1) whenever the
+# clock moves from t0 to t1; they publish sensor data for that interval.
+#
+class LocalPublisher():
+    def __init__(self,transport,topic):
+        self.transport = transport
+        self.topic = topic
+
+    def publish(self,msg):
+        self.transport.publish(self.topic,msg)
+        return
+
+class LocalSubscriber():
+    def __init__(self,transport,topic,callback):
+        self.transport = transport
+        self.topic = topic
+        self.callback = callback
+
+    def unregister(self):
+        subs = self.transport.subscribers.get(self.topic,[])
+        if self.callback in subs:
+            subs.remove(self.callback)
+        return
+
+class LocalRate():
+    def __init__(self,transport,hz):
+        self.transport = transport
+        self.period = 1.0/hz
+        self.last = transport.now()
+
+    # same semantics as rospy.Rate: sleep until one period after the
+    # last wakeup, or restart the period if we already overran it
+    def sleep(self):
+        target = self.last+self.period
+        if self.transport.now()<target:
+            self.transport.advanceTo(target)
+            self.last = target
+        else:
+            self.last = self.transport.now()
+        if self.transport.isShutdown():
+            raise self.transport.InterruptException("shutdown")
+        return
+
+#
+# TriggerRate: same sleep() as a rate, but returns as soon as event is set
+# (by a sensor callback), and at least every timeout seconds. Events that
+# arrive while the caller is busy count once; after a wakeup there is no
+# other one for 1/maxRate seconds.
+#
+class TriggerRate():
+    def __init__(self,transport,event,maxRate,timeout):
+        self.transport = transport
+        self.event = event
+        self.minPeriod = 1.0/maxRate
+        self.timeout = timeout
+        self.last = transport.now()
+
+    def sleep(self):
+        transport = self.transport
+        earliest = self.last+self.minPeriod
+        if transport.now()<earliest:
+            transport.sleep(earliest-transport.now())
+        left = self.last+self.timeout-transport.now()
+        if left>0 and not transport.isShutdown():
+            transport.waitEvent(self.event,left)
+        self.event.clear()
+        self.last = transport.now()
+        if transport.isShutdown():
+            raise transport.InterruptException("shutdown")
+        return
+
+#
+# LatestWorker: runs handler(msg,stamp) on its own thread for the newest
+# message only. put() never blocks; a message that is still waiting when
+# the next one arrives is dropped (a mailbox with a single slot), so a
+# slow handler falls behind by at most one message instead of a queue.
+# stamp is the clock time the message arrived; the age of its result is
+# the clock time the handler finished minus stamp.
+#
+class LatestWorker():
+    def __init__(self,handler,clock,name="latest"):
+        self.handler = handler
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.pending = None # (msg,stamp) waiting for the thread
+        self.received,self.processed,self.dropped = 0,0,0
+        self.first = None # clock time of the first message
+        self.age = float('nan') # of the last result
+        self.ageTotal,self.ageMax = 0.0,0.0
+        self.running = True
+        self.thread = threading.Thread(target=self.run,name=name,daemon=True)
+        self.thread.start()
+
+    def put(self,msg,stamp):
+        with self.cond:
+            if self.pending is not None:
+                self.dropped += 1
+            if self.first is None:
+                self.first = stamp
+            self.pending = (msg,stamp)
+            self.received += 1
+            self.cond.notify()
+        return
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                msg,stamp = self.pending
+                self.pending = None
+            try:
+                self.handler(msg,stamp)
+            except Exception:
+                import traceback
+                traceback.print_exc() # keep going with the next message
+            age = self.clock()-stamp
+            with self.cond:
+                self.processed += 1
+                self.age = age
+                self.ageTotal += age
+                self.ageMax = max(self.ageMax,age)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join(1.0)
+        return
+
+    # messages received, processed and dropped, processed per second,
+    # and the last, mean and largest result age in seconds
+    def stats(self):
+        with self.cond:
+            elapsed = self.clock()-self.first if self.first is not None else 0.0
+            return {'received':self.received,'processed':self.processed,'dropped':self.dropped,
+                    'rate':self.processed/elapsed if elapsed>0 else 0.0,
+                    'age':self.age,'ageMean':self.ageTotal/self.processed if self.processed else float('nan'),
+                    'ageMax':self.ageMax}
+
+class LocalTransport():
+    isLocal = True
+    InterruptException = BehaviorInterrupt
+    eventQuantum = 0.002 # seconds, clock step while waiting for an event
+
+    # duration: simulated seconds after which the transport shuts down
+    def __init__(self,duration=None):
+        self.time = 0.0
+        self.duration = duration
+        self.subscribers = {} # topic -> list of callbacks
+        self.steppers = []
+        self.shutdownCallbacks = []
+        self.shutdownFlag = False
+        self.lock = threading.RLock() # clock is shared by vehicle threads
+        self.fleetPoses = None # pose table of the vehicles on this transport, see BBbraitenrosT3.poseTable
+
+    def initNode(self,name):
+        return
+
+    def subscribe(self,topic,msgType,callback):
+        self.subscribers.setdefault(topic,[]).append(callback)
+        return LocalSubscriber(self,topic,callback)
+
+    def publisher(self,topic,msgType):
+        return LocalPublisher(self,topic)
+
+    # deliver a message to every subscriber of topic, in subscription order
+    def publish(self,topic,msg):
+        for callback in self.subscribers.get(topic,()):
+            callback(msg)
+        return
+
+    def rate(self,hz):
+        return LocalRate(self,hz)
+
+    # move the clock in small steps until a stepper or callback sets event
+    def waitEvent(self,event,timeout):
+        deadline = self.time+timeout
+        while not event.is_set() and self.time<deadline and not self.shutdownFlag:
+            self.advanceTo(min(self.time+self.eventQuantum,deadline))
+        return event.is_set()
+
+    def sleep(self,secs):
+        self.advanceTo(self.time+secs)
+        return
+
+    def now(self):
+        return self.time
+
+    # add a stepper(t0,t1) to be called as the clock moves
+    def addStepper(self,stepper):
+        self.steppers.append(stepper)
+        return
+
+    # move the simulated clock forward to t
+    def advanceTo(self,t):
+        with self.lock:
+            if self.duration is not None and t>self.duration:
+                t = self.duration
+            if t>self.time:
+                t0 = self.time
+                for stepper in self.steppers:
+                    stepper(t0,t)
+                self.time = t
+            if self.duration is not None and self.time>=self.duration:
+                self.shutdown()
+        return
+
+    def isShutdown(self):
+        return self.shutdownFlag
+
+    def shutdown(self):
+        if self.shutdownFlag:
+            return
+        self.shutdownFlag = True
+        for callback in self.shutdownCallbacks:
+            callback()
+        return
+
+    def onShutdown(self,callback):
+        self.shutdownCallbacks.append(callback)
+        return
+
+    def log(self,text):
+        print(text)
+        return
+
+#----------------------------------END-----------------------------
@@ -0,0 +1,262 @@
+#
+# BRAITENROS visualization
+# Camera frames, target masks, sensor state and the trajectory of a
+# vehicle go into a shared memory block; a separate viewer process shows
+# them, so the robot never waits on a window or a plot
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+
+#
+# Visualizer(title, camera, mask, plots, method): the robot side. start()
+# makes the shared block and starts the viewer process (method: the
+# multiprocessing start method, 'spawn' so the viewer does not inherit
+# the vehicle's threads and ROS connection); then
+#   frame(image,mask)       a camera frame (BGR) and/or target mask
+#   sample(t,pose,vl,vr,sensors)   once per behave() tick
+# only copy into the block: frames shrunk to previewSize straight into
+# their slot, samples into a ring of sampleCapacity rows. close() tells
+# the viewer the run is over; its windows stay open until closed (ESC).
+#
+# Layout of the block: a header of int64 counters, two frame slots (the
+# writer fills the one the viewer is not told about, then bumps the frame
+# counter), the latest sensor values, and the sample ring. The viewer
+# checks the frame counter again after copying a slot and drops the copy
+# if the writer lapped it.
+# ----------------------------------------------
+
+previewSize = (320,240) # width, height of the frames shown
+sampleCapacity = 1<<16 # trajectory samples kept in the ring
+sampleFields = 6 # t, x, y, yaw, vleft, vright
+sensorNames = ('lf_touch','lb_touch','rb_touch','rf_touch',
+               'lf_detect','lb_detect','rb_detect','rf_detect','lf_light','rf_light')
+maxPlotPoints = 2000 # trajectory points drawn, decimated with brplot
+
+FRAMES,SAMPLES,CLOSED,HASFRAME,HASMASK,ATTACHED = range(6) # header counters
+headerSize = 8
+
+def blockArrays(buf):
+    w,h = previewSize
+    at = 0
+    header = np.ndarray(headerSize,np.int64,buf,at); at += 8*headerSize
+    frames = np.ndarray((2,h,w,3),np.uint8,buf,at); at += 2*h*w*3
+    masks = np.ndarray((2,h,w),np.uint8,buf,at); at += 2*h*w
+    at = (at+7)//8*8
+    sensors = np.ndarray(len(sensorNames),np.float64,buf,at); at += 8*len(sensorNames)
+    samples = np.ndarray((sampleCapacity,sampleFields),np.float64,buf,at)
+    return header,frames,masks,sensors,samples
+
+def blockSize():
+    w,h = previewSize
+    at = (8*headerSize+2*h*w*3+2*h*w+7)//8*8
+    return at+8*len(sensorNames)+8*sampleCapacity*sampleFields
+
+class Visualizer():
+
+    def __init__(self,title="",camera=True,mask=False,plots=True,method='spawn'):
+        self.title = title
+        self.options = {'camera':camera,'mask':mask,'plots':plots}
+        self.context = multiprocessing.get_context(method)
+        self.memory = None
+        self.process = None
+        self.lock = threading.Lock() # frame may come from an image thread while close runs
+
+    def start(self):
+        from multiprocessing import shared_memory
+        self.memory = shared_memory.SharedMemory(create=True,size=blockSize())
+        self.header,self.frames,self.masks,self.sensors,self.samples = blockArrays(self.memory.buf)
+        self.header[:] = 0
+        self.sensors[:] = 0
+        self.process = self.context.Process(target=runViewer,args=(self.memory.name,self.title,self.options),
+                                            name="viewer"+self.title)
+        self.process.start()
+        return self
+
+    # the camera frame (BGR) and/or the 0/255 target mask of one image
+    def frame(self,image=None,mask=None):
+        import cv2
+        with self.lock:
+            if self.memory is None:
+                return
+            slot = (int(self.header[FRAMES])+1)%2 # the one the viewer is not reading
+            if image is not None:
+                cv2.resize(image,previewSize,dst=self.frames[slot],interpolation=cv2.INTER_AREA)
+                self.header[HASFRAME] = 1
+            if mask is not None:
+                cv2.resize(mask,previewSize,dst=self.masks[slot],interpolation=cv2.INTER_NEAREST)
+                self.header[HASMASK] = 1
+            self.header[FRAMES] += 1
+        return
+
+    # one trajectory sample and the sensor values (in sensorNames order)
+    def sample(self,t,x,y,yaw,vleft,vright,sensors=None):
+        with self.lock:
+            if self.memory is None:
+                return
+            n = int(self.header[SAMPLES])
+            self.samples[n%sampleCapacity] = (t,x,y,yaw,vleft,vright)
+            if sensors is not None:
+                self.sensors[:] = sensors
+            self.header[SAMPLES] = n+1
+        return
+
+    # the run is over: the viewer keeps showing what it has (once it has
+    # attached to the block, which close waits for, up to wait seconds)
+    def close(self,wait=5.0):
+        with self.lock:
+            if self.memory is None:
+                return
+            self.header[CLOSED] = 1
+        deadline = time.time()+wait
+        while self.process.is_alive() and time.time()<deadline:
+            with self.lock:
+                if self.memory is None: # closed by another thread meanwhile
+                    return
+                if self.header[ATTACHED]:
+                    break
+            time.sleep(0.01)
+        with self.lock: # not while a frame or sample is being written
+            if self.memory is None:
+                return
+            self.header = self.frames = self.masks = self.sensors = self.samples = None
+            self.memory.close()
+            self.memory.unlink() # the viewer keeps its own mapping
+            self.memory = None
+        return
+
+#
+# the viewer process
+#
+
+def drawSensors(image,values):
+    import cv2
+    lines = ["touch  {:.2f} {:.2f} {:.2f} {:.2f}".format(*values[0:4]),
+             "detect {:.2f} {:.2f} {:.2f} {:.2f}".format(*values[4:8]),
+             "light  {:.0f} {:.0f}".format(*values[8:10])]
+    for i,text in enumerate(lines):
+        cv2.putText(image,text,(5,15+15*i),cv2.FONT_HERSHEY_PLAIN,1.0,(0,255,255),1)
+    return image
+
+class Plots():
+
+    def __init__(self,title):
+        from matplotlib import pyplot as plt
+        if plt.get_backend().lower() in ('agg','pdf','ps','svg','pgf','cairo','template'):
+            raise RuntimeError("no display for the plots")
+        self.plt = plt
+        plt.ion()
+        self.figure,(self.trackAxes,self.motorAxes) = plt.subplots(1,2,figsize=(10,4.5))
+        self.figure.canvas.manager.set_window_title("Braitenros "+title)
+        self.track, = self.trackAxes.plot([],[],'.-',markersize=2,linewidth=0.5)
+        self.trackAxes.set_title("Robot position")
+        self.trackAxes.set_xlabel("X")
+        self.trackAxes.set_ylabel("Y")
+        self.left, = self.motorAxes.plot([],[],label="Left")
+        self.right, = self.motorAxes.plot([],[],label="Right")
+        self.motorAxes.set_title("Motor speeds")
+        self.motorAxes.set_xlabel("Time")
+        self.motorAxes.set_ylabel("Speed")
+        self.motorAxes.legend(loc="upper right")
+
+    def isOpen(self):
+        return self.plt.fignum_exists(self.figure.number)
+
+    def update(self,rows):
+        import brplot
+        self.track.set_data(*brplot.reducePath(rows[:,1],rows[:,2],maxPlotPoints))
+        self.left.set_data(*brplot.reduceSeries(rows[:,0],rows[:,4],maxPlotPoints))
+        self.right.set_data(*brplot.reduceSeries(rows[:,0],rows[:,5],maxPlotPoints))
+        for axes in (self.trackAxes,self.motorAxes):
+            axes.relim()
+            axes.autoscale_view()
+        self.figure.canvas.draw_idle()
+        return
+
+    def pump(self):
+        self.figure.canvas.flush_events()
+        return
+
+def runViewer(name,title,options,interval=0.05):
+    from multiprocessing import shared_memory
+    import cv2
+    try:
+        memory = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError: # the run was over before we started
+        return
+    header,frames,masks,sensors,samples = blockArrays(memory.buf)
+    header[ATTACHED] = 1
+    parent = os.getppid()
+    plots = None
+    if options['plots']:
+        try:
+            plots = Plots(title)
+        except Exception: # no display
+            plots = None
+    windows = [] # the OpenCV windows shown so far
+    history = np.empty((1024,sampleFields))
+    count = 0 # samples copied into history
+    seen = 0 # frame counter of the frame shown
+    plotted = 0
+    closed = False
+    try:
+        while True:
+            if not closed:
+                closed = bool(header[CLOSED]) or os.getppid()!=parent
+                n = int(header[FRAMES])
+                if n!=seen:
+                    slot = n%2
+                    image,mask = frames[slot].copy(),masks[slot].copy()
+                    if int(header[FRAMES])-n<2: # not lapped while copying
+                        seen = n
+                        shown = []
+                        if options['camera'] and header[HASFRAME]:
+                            shown.append(("Camera"+title,drawSensors(image,sensors.copy())))
+                        if options['mask'] and header[HASMASK]:
+                            shown.append(("Target"+title,mask))
+                        try:
+                            for window,picture in shown:
+                                cv2.imshow(window,picture)
+                                if window not in windows:
+                                    windows.append(window)
+                        except cv2.error: # no display
+                            options['camera'] = options['mask'] = False
+                head = int(header[SAMPLES])
+                start = max(count,head-sampleCapacity)
+                if head>start:
+                    if head>len(history):
+                        history = np.resize(history,(max(head,2*len(history)),sampleFields))
+                    idx = np.arange(start,head)
+                    history[idx] = samples[idx%sampleCapacity]
+                    count = head
+            if plots is not None and plots.isOpen():
+                if count!=plotted:
+                    plots.update(history[:count])
+                    plotted = count
+                plots.pump()
+            if windows:
+                if cv2.waitKey(int(interval*1000))==27: # ESC
+                    break
+                windows = [w for w in windows if cv2.getWindowProperty(w,cv2.WND_PROP_VISIBLE)>=1]
+            else:
+                time.sleep(interval)
+            if closed and not windows and (plots is None or not plots.isOpen()):
+                break
+    finally:
+        if windows:
+            cv2.destroyAllWindows()
+        del header,frames,masks,sensors,samples
+        memory.close()
+    return
+
+#----------------------------------END-----------------------------
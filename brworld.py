@@ -0,0 +1,345 @@
+#
+# BRAITENROS world geometry
+# A 2D scene of walls and lights with a uniform grid index for fast ray
+# casting, and a loader for the myworld*.launch and Gazebo .world files
+#
+
+# c dml 2020,2021,2022,2023,2024 Fordham University NYC FRCV Lab
+#
+# Permission is granted to copy this code as long as you include the headers
+# and attribution and this message. No support is implied.
+#
+
+import math
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+#
+# Scene: walls are 2D segments (what the laser plane cuts through the
+# world), each with a color and height for the camera. The grid index keeps,
+# for every cell, the walls that are within a given radius of that cell, so
+# a 360 ray laser only tests the walls it could possibly reach.
+#
+# loadLaunch(path) -- a World with the scene and the robot spawn points of a
+#                     roslaunch file; the referenced .world file is read too
+# loadWorld(path)  -- a Scene from a Gazebo .world (SDF) file
+# ----------------------------------------------
+
+laserHeight = 0.17 # meters, height of the T3 laser plane
+cylinderSides = 12 # polygon used for cylinders and spheres
+
+# BGR colors for the usual Gazebo material scripts
+materialColors = {
+    'Gazebo/White':(255,255,255), 'Gazebo/Grey':(128,128,128),
+    'Gazebo/Gray':(128,128,128), 'Gazebo/DarkGrey':(80,80,80),
+    'Gazebo/Black':(20,20,20), 'Gazebo/Red':(0,0,255),
+    'Gazebo/Green':(0,255,0), 'Gazebo/Blue':(255,0,0),
+    'Gazebo/Yellow':(0,255,255), 'Gazebo/Orange':(0,128,255),
+    'Gazebo/Wood':(50,100,150), 'Gazebo/Bricks':(60,80,170),
+}
+
+class Scene():
+
+    def __init__(self,cellSize=0.5):
+        self.cellSize = cellSize
+        self.walls = np.zeros((0,4))
+        self.wallColors = np.zeros((0,3),dtype=np.uint8)
+        self.wallHeights = np.zeros(0)
+        self.lights = np.zeros((0,3)) # x,y,radius
+        self.lightColors = np.zeros((0,3),dtype=np.uint8)
+        self.lightHeights = np.zeros(0)
+        self.index = None # built on first query
+        self.nearby = {}  # (cell,reach) -> wall indices
+
+    # add a wall from x0,y0 to x1,y1; color is BGR as seen by the camera
+    def addWall(self,x0,y0,x1,y1,color=(128,128,128),height=1.0):
+        self.walls = np.vstack([self.walls,[x0,y0,x1,y1]])
+        self.wallColors = np.vstack([self.wallColors,np.array(color,dtype=np.uint8)])
+        self.wallHeights = np.append(self.wallHeights,height)
+        self.index = None
+        return
+
+    # add the outline of a polygon given as a list of x,y corners
+    def addPolygon(self,pts,color=(128,128,128),height=1.0):
+        for i in range(len(pts)):
+            x0,y0 = pts[i]
+            x1,y1 = pts[(i+1)%len(pts)]
+            self.addWall(x0,y0,x1,y1,color,height)
+        return
+
+    # add a box centered on cx,cy of size sx by sy, rotated by yaw
+    def addBox(self,cx,cy,sx,sy,yaw=0.0,color=(128,128,128),height=1.0):
+        c,s = math.cos(yaw),math.sin(yaw)
+        corners = [(-sx/2,-sy/2),(sx/2,-sy/2),(sx/2,sy/2),(-sx/2,sy/2)]
+        self.addPolygon([(cx+c*x-s*y,cy+s*x+c*y) for x,y in corners],color,height)
+        return
+
+    # add a cylinder of radius r as a polygon
+    def addCylinder(self,cx,cy,r,color=(128,128,128),height=1.0):
+        a = np.arange(cylinderSides)*(2*math.pi/cylinderSides)
+        self.addPolygon(list(zip(cx+r*np.cos(a),cy+r*np.sin(a))),color,height)
+        return
+
+    # add a light source (only the camera sees it), default white paper
+    def addLight(self,x,y,color=(255,255,255),radius=0.15,height=0.3):
+        self.lights = np.vstack([self.lights,[x,y,radius]])
+        self.lightColors = np.vstack([self.lightColors,np.array(color,dtype=np.uint8)])
+        self.lightHeights = np.append(self.lightHeights,height)
+        return
+
+    # grid cell of a point
+    def cell(self,x,y):
+        return (int(math.floor(x/self.cellSize)),int(math.floor(y/self.cellSize)))
+
+    # bucket every wall into each grid cell its bounding box touches
+    def buildIndex(self):
+        self.index = {}
+        self.nearby = {}
+        for i,(x0,y0,x1,y1) in enumerate(self.walls):
+            cx0,cy0 = self.cell(min(x0,x1),min(y0,y1))
+            cx1,cy1 = self.cell(max(x0,x1),max(y0,y1))
+            for cx in range(cx0,cx1+1):
+                for cy in range(cy0,cy1+1):
+                    self.index.setdefault((cx,cy),[]).append(i)
+        return
+
+    # indices of the walls that may be within reach of point x,y
+    # (the list for each cell and reach is computed once and kept)
+    def nearbyWalls(self,x,y,reach):
+        if self.index is None:
+            self.buildIndex()
+        c = self.cell(x,y)
+        key = (c,reach)
+        found = self.nearby.get(key)
+        if found is None:
+            n = int(math.ceil(reach/self.cellSize))+1
+            ids = set()
+            for cx in range(c[0]-n,c[0]+n+1):
+                for cy in range(c[1]-n,c[1]+n+1):
+                    ids.update(self.index.get((cx,cy),()))
+            found = np.array(sorted(ids),dtype=int)
+            self.nearby[key] = found
+        return found
+
+    # bounds of all the walls, x0,y0,x1,y1
+    def bounds(self):
+        if len(self.walls)==0:
+            return None
+        xs = np.concatenate([self.walls[:,0],self.walls[:,2]])
+        ys = np.concatenate([self.walls[:,1],self.walls[:,3]])
+        return xs.min(),ys.min(),xs.max(),ys.max()
+
+# what a launch file describes: the scene and where each robot starts
+class World():
+    def __init__(self,scene,spawns,worldFile=None):
+        self.scene = scene
+        self.spawns = spawns # list of (modelName,x,y,yaw)
+        self.worldFile = worldFile
+
+#
+# Gazebo SDF .world files
+#
+
+# a pose as x,y,z,yaw (roll and pitch are ignored in 2D)
+def parsePose(elem):
+    if elem is None or not elem.text:
+        return (0.0,0.0,0.0,0.0)
+    v = [float(t) for t in elem.text.split()]+[0.0]*6
+    return (v[0],v[1],v[2],v[5])
+
+# pose b given relative to pose a
+def composePose(a,b):
+    c,s = math.cos(a[3]),math.sin(a[3])
+    return (a[0]+c*b[0]-s*b[1], a[1]+s*b[0]+c*b[1], a[2]+b[2], a[3]+b[3])
+
+def parseColor(elem):
+    material = elem.find('material') if elem is not None else None
+    if material is None:
+        return (128,128,128)
+    name = material.find('script/name')
+    if name is not None and name.text and name.text.strip() in materialColors:
+        return materialColors[name.text.strip()]
+    for tag in ('diffuse','ambient'):
+        c = material.find(tag)
+        if c is not None and c.text:
+            r,g,b = [float(t) for t in c.text.split()[:3]]
+            return (int(255*b),int(255*g),int(255*r))
+    return (128,128,128)
+
+# directories to look for model://name includes
+def modelPaths():
+    paths = [p for p in os.environ.get('GAZEBO_MODEL_PATH','').split(':') if p]
+    paths.append(os.path.expanduser('~/.gazebo/models'))
+    return paths
+
+def findModelSdf(uri):
+    name = uri.replace('model://','').strip('/')
+    for p in modelPaths():
+        d = os.path.join(p,name)
+        for f in ('model.sdf','model-1_4.sdf','model-1_5.sdf','model-1_6.sdf'):
+            if os.path.isfile(os.path.join(d,f)):
+                return os.path.join(d,f)
+    return None
+
+# add the collision geometry of one <model> that the laser plane cuts
+def addModel(scene,model,pose,statePoses):
+    name = model.get('name','')
+    if name in statePoses:
+        pose = statePoses[name]
+    else:
+        pose = composePose(pose,parsePose(model.find('pose')))
+    for link in model.findall('link'):
+        lpose = composePose(pose,parsePose(link.find('pose')))
+        visual = link.find('visual')
+        color = parseColor(visual)
+        for collision in link.findall('collision'):
+            cpose = composePose(lpose,parsePose(collision.find('pose')))
+            addGeometry(scene,collision.find('geometry'),cpose,color)
+    for sub in model.findall('model'): # nested models
+        addModel(scene,sub,pose,{})
+    for include in model.findall('include'):
+        addInclude(scene,include,pose)
+    return
+
+def addGeometry(scene,geometry,pose,color):
+    if geometry is None:
+        return
+    x,y,z,yaw = pose
+    box = geometry.find('box')
+    if box is not None:
+        sx,sy,sz = [float(t) for t in box.findtext('size').split()]
+        if z-sz/2<=laserHeight<=z+sz/2: # the laser plane cuts this box
+            scene.addBox(x,y,sx,sy,yaw,color,z+sz/2)
+        return
+    cylinder = geometry.find('cylinder')
+    if cylinder is not None:
+        r = float(cylinder.findtext('radius'))
+        length = float(cylinder.findtext('length'))
+        if z-length/2<=laserHeight<=z+length/2:
+            scene.addCylinder(x,y,r,color,z+length/2)
+        return
+    sphere = geometry.find('sphere')
+    if sphere is not None:
+        r = float(sphere.findtext('radius'))
+        if abs(laserHeight-z)<r:
+            scene.addCylinder(x,y,math.sqrt(r*r-(laserHeight-z)**2),color,z+r)
+        return
+    # planes are the floor; meshes are not supported
+    return
+
+def addInclude(scene,include,pose):
+    uri = include.findtext('uri') or ''
+    if uri in ('model://ground_plane','model://sun'): # nothing to hit
+        return
+    path = findModelSdf(uri)
+    if path is None:
+        print("Braitenros: cannot find model "+uri+", skipped")
+        return
+    # the include pose replaces the pose inside the model file
+    ipose = composePose(pose,parsePose(include.find('pose')))
+    model = ET.parse(path).getroot().find('model')
+    if model is None:
+        return
+    if model.find('pose') is not None:
+        model.remove(model.find('pose'))
+    addModel(scene,model,ipose,{})
+    return
+
+# read the models of a Gazebo world into a scene
+def loadWorld(path,scene=None):
+    if scene is None:
+        scene = Scene()
+    world = ET.parse(path).getroot()
+    if world.tag!='world':
+        world = world.find('world')
+    # poses saved by the Gazebo editor override the model poses
+    statePoses = {}
+    state = world.find('state')
+    if state is not None:
+        for m in state.findall('model'):
+            statePoses[m.get('name')] = parsePose(m.find('pose'))
+    origin = (0.0,0.0,0.0,0.0)
+    for model in world.findall('model'):
+        addModel(scene,model,origin,statePoses)
+    for include in world.findall('include'):
+        addInclude(scene,include,origin)
+    return scene
+
+#
+# roslaunch files
+#
+
+substitution = re.compile(r'\$\((\w+)\s*([^)]*)\)')
+
+# resolve $(arg ..), $(env ..), $(optenv ..), $(dirname) and $(find ..)
+def resolve(text,args,launchDir):
+    def sub(m):
+        kind,value = m.group(1),m.group(2).strip()
+        if kind=='arg':
+            return args.get(value,'')
+        if kind=='env':
+            return launchDir if value=='PWD' else os.environ.get(value,'')
+        if kind=='optenv':
+            parts = value.split(None,1)
+            return os.environ.get(parts[0],parts[1] if len(parts)>1 else '')
+        if kind=='dirname':
+            return launchDir
+        if kind=='find':
+            try:
+                import rospkg
+                return rospkg.RosPack().get_path(value)
+            except Exception:
+                return ''
+        return ''
+    return substitution.sub(sub,text or '')
+
+# the -x -y -Y options of a spawn_model node
+def spawnPose(argText):
+    opts = argText.split()
+    pose = {'-x':0.0,'-y':0.0,'-Y':0.0}
+    for i,o in enumerate(opts[:-1]):
+        if o in pose:
+            try:
+                pose[o] = float(opts[i+1])
+            except ValueError:
+                pass
+    return pose['-x'],pose['-y'],pose['-Y']
+
+def walkLaunch(elem,args,ns,launchDir,spawns,worlds):
+    args = dict(args) # declarations in a group stay in the group
+    for child in elem:
+        if child.tag=='arg':
+            value = child.get('value',child.get('default'))
+            args[child.get('name')] = resolve(value,args,launchDir)
+        elif child.tag=='group':
+            walkLaunch(child,args,ns+resolve(child.get('ns',''),args,launchDir),launchDir,spawns,worlds)
+        elif child.tag=='node' and child.get('type')=='spawn_model':
+            x,y,yaw = spawnPose(resolve(child.get('args'),args,launchDir))
+            spawns.append((ns,x,y,yaw))
+        elif child.tag=='include':
+            for a in child.findall('arg'):
+                if a.get('name')=='world_name':
+                    worlds.append(resolve(a.get('value',a.get('default')),args,launchDir))
+    return
+
+# read the robot spawn points and the world of a roslaunch file
+def loadLaunch(path):
+    launchDir = os.path.dirname(os.path.abspath(path))
+    spawns,worlds = [],[]
+    walkLaunch(ET.parse(path).getroot(),{},'',launchDir,spawns,worlds)
+    scene = Scene()
+    worldFile = None
+    for w in worlds:
+        if not os.path.isabs(w):
+            w = os.path.join(launchDir,w)
+        if os.path.isfile(w):
+            worldFile = w
+            loadWorld(w,scene)
+        else:
+            print("Braitenros: world file "+w+" not found, no walls loaded")
+    return World(scene,spawns,worldFile)
+
+#----------------------------------END-----------------------------